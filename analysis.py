@@ -5,63 +5,173 @@ This module analyses car crashes in the Czech Republic.
 
 __author__ = "Martin Kostelník (xkoste12)"
 
-from matplotlib import pyplot as plt
 import pandas as pd
-import seaborn as sns
-import numpy as np
+import pickle
 import sys
+import os
+import tempfile
+import metrics
 
 
-def get_dataframe(filename: str = "accidents.pkl.gz", verbose: bool = False) -> pd.DataFrame:
+@metrics.timed("analysis.get_dataframe")
+def get_dataframe(filename: str = "accidents.pkl.gz", verbose: bool = False, cache_filename: str = None) -> pd.DataFrame:
     """Create dataframe with car crashes data
 
+    The optimised dataframe is cached in an uncompressed pickle next to the data file, so later calls
+    only read it from disk. The cache is rebuilt when the data file changes, categorical schema of
+    the old cache is reused, so column types do not have to be inferred again.
+
     Keyword arguments:
     filename -- name of the file containing the data (default accidents.pkl.gz)
     verbose -- if True, function prints dataframe size before and after change to category data (default False)
+    cache_filename -- name of the cache file (default filename with .opt.pkl extension)
     """
+    if cache_filename is None:
+        cache_filename = f"{os.path.splitext(os.path.splitext(filename)[0])[0]}.opt.pkl"
+
     try:
-        df = pd.read_pickle(filename, "gzip")
+        stat = os.stat(filename)
     except FileNotFoundError:
         print(f"ERROR: File '{filename}' not found. Quitting.", file=sys.stderr)
         sys.exit(1)
 
-    df["date"] = df["p2a"].astype("datetime64")
+    source = [stat.st_size, stat.st_mtime_ns]
+    cache = None
+
+    if os.path.isfile(cache_filename):
+        with open(cache_filename, "rb") as f:
+            cache = pickle.load(f)
+
+    if cache is None or cache["source"] != source:
+        metrics.count("analysis.dataframe_cache_misses")
+        df = pd.read_pickle(filename, "gzip")
+        orig_size = df.memory_usage(deep=True).sum()
+        schema = cache["schema"] if cache is not None else None
+
+        df = optimise_dataframe(df, schema)
+        cache = {"source": source, "schema": {col: str(df[col].dtype) for col in df}, "orig_size": orig_size, "df": df}
+
+        # Write under unique temporary name first, so that the cache is never left partially written
+        # and concurrent writers (e.g. report.py workers) do not overwrite each other's temporary file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_filename)), prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_filename)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    else:
+        metrics.count("analysis.dataframe_cache_hits")
+
+    df = cache["df"]
 
     if verbose:
         # 1 MB = 1048576 B
-        print(f"orig_size={df.memory_usage(deep=True).sum() / 1048576:.1f} MB")
+        print(f"orig_size={cache['orig_size'] / 1048576:.1f} MB")
+        print(f"new_size={df.memory_usage(deep=True).sum() / 1048576:.1f} MB")
 
-    # These columns will not be changed to category type
-    exclude_cols = ["region", "p2a", "date", "p13a", "p13b", "p13c", "p12", "p53", "p16"]
+    return df
 
-    # Columns with less unique values than THRESHOLD will not be changed to category type
-    THRESHOLD = 1000
 
-    for col in df:
-        if df[col].nunique() < THRESHOLD and col not in exclude_cols:
-            df[col] = df[col].astype("category")
+@metrics.timed("analysis.optimise_dataframe")
+def optimise_dataframe(df: pd.DataFrame, schema: dict = None) -> pd.DataFrame:
+    """Add date column and change columns with few unique values to category type
 
-    if verbose:
-        # 1 MB = 1048576 B
-        print(f"new_size={df.memory_usage(deep=True).sum() / 1048576:.1f} MB")
+    Keyword arguments:
+    df -- dataframe loaded from data file
+    schema -- column types from previously optimised dataframe, if columns match, they are used instead of counting unique values (default None)
+    """
+    df["date"] = df["p2a"].astype("datetime64")
+
+    if schema is not None and set(schema) == set(df.columns):
+        category_cols = [col for col, dtype in schema.items() if dtype == "category"]
+    else:
+        # These columns will not be changed to category type
+        exclude_cols = ["region", "p2a", "date", "p13a", "p13b", "p13c", "p12", "p53", "p16"]
+
+        # Columns with less unique values than THRESHOLD will not be changed to category type
+        THRESHOLD = 1000
+
+        category_cols = [col for col in df if col not in exclude_cols and df[col].nunique() < THRESHOLD]
+
+    for col in category_cols:
+        df[col] = df[col].astype("category")
 
     return df
 
 
-def plot_conseq(df: pd.DataFrame, fig_location: str = None, show_figure: bool = False):
+@metrics.timed("analysis.build_cubes")
+def build_cubes(df: pd.DataFrame, names: list = None) -> dict:
+    """Aggregate data needed by plot functions, each table is computed in one grouped pass over the dataframe
+
+    Keyword arguments:
+    df -- dataframe containing data
+    names -- names of tables to compute, "conseq", "damage" and/or "surface" (default all of them)
+
+    Returns:
+    Dictionary mapping table names to small dataframes:
+    conseq -- sums of p13a, p13b, p13c and crash count per region, sorted by crash count
+    damage -- crash count per region, damage bin and cause
+    surface -- crash count per region and month (index) and road surface state p16 (columns)
+    """
+    if names is None:
+        names = ["conseq", "damage", "surface"]
+
+    cubes = dict()
+
+    if "conseq" in names:
+        conseq = df.groupby("region", observed=True).agg(p13a=("p13a", "sum"), p13b=("p13b", "sum"), p13c=("p13c", "sum"), count=("p1", "size"))
+        cubes["conseq"] = conseq.sort_values("count", ascending=False, kind="stable")
+
+    if "damage" in names:
+        cause_bins = [99, 200, 300, 400, 500, 600, 700]
+        cause_labels = [
+            "Nezaviněna řidičem", "Nepřiměřená rychlost jízdy",
+            "Nesprávné předjíždění", "Nedání přednosti v jízdě",
+            "Nesprávný způsob jízdy", "Technická závada vozidla",
+        ]
+        cause = pd.cut(df["p12"], bins=cause_bins, labels=cause_labels).rename("cause")
+
+        damage_bins = [0, 50, 200, 500, 1000, float("inf")]
+        damage_labels = ["< 50", "50 - 200", "200 - 500", "500 - 1000", "> 1000"]
+        damage = pd.cut(df["p53"] / 10, bins=damage_bins, labels=damage_labels, include_lowest=True).rename("damage")
+
+        cubes["damage"] = df.groupby([df["region"], damage, cause], observed=True).size().rename("count")
+
+    if "surface" in names:
+        surface = df.groupby(["region", pd.Grouper(key="date", freq="M"), "p16"], observed=True).size()
+        cubes["surface"] = surface.unstack("p16", fill_value=0)
+
+    return cubes
+
+
+@metrics.timed("analysis.plot_conseq")
+def plot_conseq(df: pd.DataFrame, fig_location: str = None, show_figure: bool = False, cubes: dict = None):
     """Plot car crashes data concerning injuries
 
     Keyword arguments:
     df -- dataframe containing data
     fig_location -- plots will be saved to this file (default None)
     show_figure -- if True, function displays the plots on screen
+    cubes -- tables computed by build_cubes, computed from df if not given (default None)
     """
+    from matplotlib import pyplot as plt # Plotting libraries are imported only when plotting
+    import seaborn as sns
+
+    if cubes is None:
+        cubes = build_cubes(df, ["conseq"])
+
+    conseq = cubes["conseq"].reset_index()
+    order = conseq["region"]
+
     fig, (ax1, ax2, ax3, ax4) = plt.subplots(4, 1, figsize=(10, 15))
 
-    sns.barplot(data=df, x="region", y="p13a", ax=ax1, estimator=np.sum, order=df["region"].value_counts().index, ci=None, color="mediumblue")
-    sns.barplot(data=df, x="region", y="p13b", ax=ax2, estimator=np.sum, order=df["region"].value_counts().index, ci=None, color="mediumblue")
-    sns.barplot(data=df, x="region", y="p13c", ax=ax3, estimator=np.sum, order=df["region"].value_counts().index, ci=None, color="mediumblue")
-    sns.countplot(data=df, x="region", ax=ax4, order=df["region"].value_counts().index, color="mediumblue")
+    sns.barplot(data=conseq, x="region", y="p13a", ax=ax1, order=order, ci=None, color="mediumblue")
+    sns.barplot(data=conseq, x="region", y="p13b", ax=ax2, order=order, ci=None, color="mediumblue")
+    sns.barplot(data=conseq, x="region", y="p13c", ax=ax3, order=order, ci=None, color="mediumblue")
+    sns.barplot(data=conseq, x="region", y="count", ax=ax4, order=order, ci=None, color="mediumblue")
 
     ax1.set(xlabel="Kraj", ylabel="Počet", title="Úmrtí")
     ax1.set_fc("silver")
@@ -83,36 +193,37 @@ def plot_conseq(df: pd.DataFrame, fig_location: str = None, show_figure: bool =
     plt.close(fig)
 
 
-def plot_damage(df: pd.DataFrame, fig_location: str = None, show_figure: bool = False):
+@metrics.timed("analysis.plot_damage")
+def plot_damage(df: pd.DataFrame, fig_location: str = None, show_figure: bool = False, cubes: dict = None):
     """Plot car crashes data concerning property damage
 
     Keyword arguments:
     df -- dataframe containing data
     fig_location -- plots will be saved to this file (default None)
     show_figure -- if True, function displays the plots on screen
+    cubes -- tables computed by build_cubes, computed from df if not given (default None)
     """
+    from matplotlib import pyplot as plt
+    import seaborn as sns
+
+    if cubes is None:
+        cubes = build_cubes(df, ["damage"])
+
+    damage = cubes["damage"]
+    damage_labels = damage.index.get_level_values("damage").categories
+    cause_labels = damage.index.get_level_values("cause").categories
+
     regions = ["MSK", "JHM", "OLK", "ZLK"]
     fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(10, 10))
     axs = [ax1, ax2, ax3, ax4]
 
     i = 0
     for region in regions:
-        tmp_df = df.loc[df["region"] == region].copy()
-        tmp_df["p53"] /= 10
-
-        cause_bins = [99, 200, 300, 400, 500, 600, 700]
-        cause_labels = [
-            "Nezaviněna řidičem", "Nepřiměřená rychlost jízdy",
-            "Nesprávné předjíždění", "Nedání přednosti v jízdě",
-            "Nesprávný způsob jízdy", "Technická závada vozidla",
-        ]
-        cause=pd.cut(tmp_df["p12"], bins=cause_bins, labels=cause_labels)
+        # Every combination of damage and cause is plotted, even if there were no crashes
+        full_index = pd.MultiIndex.from_product([damage_labels, cause_labels], names=["damage", "cause"])
+        tmp_df = damage.xs(region, level="region").reindex(full_index, fill_value=0).reset_index()
 
-        damage_bins = [0, 50, 200, 500, 1000, float("inf")]
-        damage_labels = ["< 50", "50 - 200", "200 - 500", "500 - 1000", "> 1000"]
-        damage=pd.cut(tmp_df["p53"], bins=damage_bins, labels=damage_labels, include_lowest=True)
-
-        sns.countplot(ax=axs[i], x=damage, hue=cause)
+        sns.barplot(data=tmp_df, ax=axs[i], x="damage", y="count", hue="cause", order=damage_labels, hue_order=cause_labels, ci=None)
         axs[i].set(title=region, yscale="log", xlabel="Škoda (tisíc Kč)", ylabel="Počet")
         axs[i].legend(loc="upper right", frameon=False, fontsize=8)
 
@@ -132,31 +243,38 @@ def plot_damage(df: pd.DataFrame, fig_location: str = None, show_figure: bool =
     plt.close(fig)
 
 
-def plot_surface(df: pd.DataFrame , fig_location: str = None, show_figure: bool = False):
+@metrics.timed("analysis.plot_surface")
+def plot_surface(df: pd.DataFrame , fig_location: str = None, show_figure: bool = False, cubes: dict = None):
     """Plot car crashes data based on road quality
 
     Keyword arguments:
     df -- dataframe containing data
     fig_location -- plots will be saved to this file (default None)
     show_figure -- if True, function displays the plots on screen
+    cubes -- tables computed by build_cubes, computed from df if not given (default None)
     """
+    from matplotlib import pyplot as plt
+    import seaborn as sns
+
+    if cubes is None:
+        cubes = build_cubes(df, ["surface"])
+
     regions = ["MSK", "JHM", "OLK", "ZLK"]
     fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(12, 5))
     axs = [ax1, ax2, ax3, ax4]
 
     i = 0
     for region in regions:
-        tmp_df = df.loc[df["region"] == region].copy()
-        tmp_df = tmp_df[["p16", "p1", "date"]].copy()
+        ctab = cubes["surface"].xs(region, level="region")
+        ctab = ctab.loc[:, (ctab != 0).any()] # Only road states which occured in the region
 
         colnames = {
             1: "suchý nezněčištěný", 2: "suchý znečištěný", 3: "mokrý",
             4: "bláto", 5: "náledí, ujetý sníh - posypané", 6: "náledí, ujetý sníh - neposypané",
             7: "olej, nafta apod.", 8: "souvislý sníh", 9: "náhlá změna stavu", 0: "jiný stav",
         }
-        ctab = pd.crosstab(index=tmp_df["date"], columns=tmp_df["p16"], values=tmp_df["p1"], aggfunc=len)
-        ctab.rename(columns=colnames, inplace=True)
-        resampled = ctab.resample('M').sum()
+        ctab = ctab.rename(columns=colnames)
+        resampled = ctab.resample('M').sum() # Fill months without crashes
         resampled = resampled.stack().reset_index()
 
         sns.lineplot(data=resampled, ax=axs[i], x="date", hue="p16", y=resampled[0])
@@ -186,6 +304,7 @@ def plot_surface(df: pd.DataFrame , fig_location: str = None, show_figure: bool
 
 if __name__ == "__main__":
     df = get_dataframe(verbose=True)
-    plot_conseq(df, "conseq.pdf")
-    plot_damage(df, "damage.pdf")
-    plot_surface(df, "surface.pdf")
+    cubes = build_cubes(df)
+    plot_conseq(df, "conseq.pdf", cubes=cubes)
+    plot_damage(df, "damage.pdf", cubes=cubes)
+    plot_surface(df, "surface.pdf", cubes=cubes)
@@ -0,0 +1,496 @@
+"""IZV project benchmarks
+
+This module measures performance of data processing on synthetic data. The pipeline benchmark
+generates data archives in the layout of the original data source and times every stage
+from parsing to rendering figures, results are saved as JSON to compare runs between commits.
+The download benchmark times downloading of archives from a local HTTP server (first download,
+revalidation of unchanged archives and resuming of partial downloads).
+The tiles benchmark times the tile cache and basemaps on locally generated tiles.
+Results of the benchmarks are checked by tests in the tests folder.
+The startup benchmark measures how long entry points and modules take to start in a new interpreter.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import argparse
+import csv
+import http.server
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from zipfile import ZipFile, ZIP_DEFLATED
+import numpy as np
+import download as dl
+
+# Ranges of generated values [low, high) of columns used by analysis, other columns get values in [0, 100)
+COLUMN_RANGES = {
+    "p12": (100, 700), "p13a": (0, 2), "p13b": (0, 3), "p13c": (0, 4), "p16": (0, 10), "p18": (0, 8),
+    "p53": (0, 20000), "p5a": (1, 3), "d": (-900000, -430000), "e": (-1230000, -930000),
+}
+
+def parse_arguments():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("benchmark", help="Benchmark to run (default columns)", nargs="?", choices=["columns", "pipeline", "download", "tiles", "startup"], default="columns")
+    parser.add_argument("--rows", help="Number of rows in synthetic region (columns), rows per region and archive (pipeline, download)", type=int)
+    parser.add_argument("--archives", help="Number of generated archives (pipeline)", type=int, default=2)
+    parser.add_argument("--workdir", help="Directory for generated data and figures (pipeline, default temporary directory)")
+    parser.add_argument("--output", help="JSON file with results (pipeline)", default="benchmark.json")
+    parser.add_argument("--seed", help="Random seed", type=int, default=0)
+    parser.add_argument("--repeat", help="Number of runs of every command (startup)", type=int, default=5)
+
+    return parser.parse_args()
+
+
+def make_rows(data_types, n_rows, seed=0, headers=None, year=None):
+    """Generate synthetic CSV rows resembling parsed region data
+
+    Arguments:
+    data_types -- data types of columns (DataDownloader.data_types)
+    n_rows -- number of generated rows
+
+    Keyword arguments:
+    seed -- random seed (default 0)
+    headers -- column names, used to generate values in COLUMN_RANGES (default None)
+    year -- year of generated dates (default dates from 2016 to 2020)
+
+    Returns:
+    List of rows, each row being a list of strings
+    """
+    rng = np.random.RandomState(seed)
+    columns = list()
+
+    if headers is None:
+        headers = [None] * len(data_types)
+
+    for header, t in zip(headers, data_types):
+        if t.startswith("int"):
+            col = rng.randint(*COLUMN_RANGES.get(header, (0, 100)), size=n_rows).astype(str)
+        elif t.startswith("float"):
+            col = np.char.replace(np.round(rng.uniform(*COLUMN_RANGES.get(header, (-800000, -400000)), size=n_rows), 2).astype(str), '.', ',')
+        elif t.startswith("datetime64") and year is not None:
+            col = (np.datetime64(f"{year}-01-01") + rng.randint(0, 365, size=n_rows)).astype(str)
+        elif t.startswith("datetime64"):
+            col = (np.datetime64("2016-01-01") + rng.randint(0, 1700, size=n_rows)).astype(str)
+        else:
+            col = rng.choice(["A", "PHA", "Ulice", "Silnice I. třídy"], size=n_rows)
+
+        # Roughly 1 % of cells is empty, just like in real data
+        col[rng.random_sample(n_rows) < 0.01] = ""
+        columns.append(col)
+
+    return np.stack(columns, axis=1).tolist()
+
+
+def legacy_build_columns(data_types, rows):
+    """Reference cell by cell implementation of DataDownloader.build_columns using the original data types"""
+    data_types = ["int" if t.startswith("int") else "float" if t.startswith("float") else "U64" for t in data_types]
+    np_data = list()
+    l = len(rows)
+    col_index = 0
+
+    for t in data_types:
+        np_data.append(np.ndarray(shape = (l), dtype=t))
+
+        for i in range(l):
+            if t == "U64":
+                np_data[col_index][i] = rows[i][col_index]
+            else:
+                try:
+                    if t == "int":
+                        np_data[col_index][i] = rows[i][col_index]
+                    elif t == "float":
+                        np_data[col_index][i] = rows[i][col_index].replace(',', '.')
+                except ValueError:
+                    np_data[col_index][i] = dl.ERROR_VALUE
+
+        col_index += 1
+
+    return np_data
+
+
+def timed(func, *args):
+    """Run function and return its result and wall time in seconds"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_build_columns(n_rows, seed=0):
+    """Compare speed of cell by cell and columnar conversion of a synthetic region, results are checked by tests/test_columns.py
+
+    Arguments:
+    n_rows -- number of rows in synthetic region
+
+    Keyword arguments:
+    seed -- random seed (default 0)
+    """
+    downloader = dl.DataDownloader()
+    rows = make_rows(downloader.data_types, n_rows, seed)
+
+    _, legacy_time = timed(legacy_build_columns, downloader.data_types, rows)
+    _, columnar_time = timed(downloader.build_columns, rows)
+
+    print(f"Rows: {n_rows}")
+    print(f"Cell by cell: {legacy_time:.2f} s")
+    print(f"Columnar: {columnar_time:.2f} s")
+    print(f"Speedup: {legacy_time / columnar_time:.1f}x")
+
+
+def write_archives(folder, archives, region_files, data_types, n_rows, seed=0, headers=None):
+    """Write synthetic data archives in the layout of the original data source, that is ZIP archives
+    containing one cp1250 encoded CSV file delimited by ';' for every region
+
+    Arguments:
+    folder -- folder of the archives
+    archives -- names of the archives, year of data is taken from the name
+    region_files -- dictionary mapping region acronyms to names of CSV files (DataDownloader.region_files)
+    data_types -- data types of columns (DataDownloader.data_types)
+    n_rows -- number of rows of every region in every archive
+
+    Keyword arguments:
+    seed -- random seed (default 0)
+    headers -- column names, see make_rows (default None)
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    for i, archive in enumerate(archives):
+        with ZipFile(os.path.join(folder, archive), "w", ZIP_DEFLATED) as zip_file:
+            for j, region_file in enumerate(region_files.values()):
+                rows = make_rows(data_types, n_rows, seed + i * len(region_files) + j, headers, dl.archive_year(archive))
+
+                data = io.StringIO()
+                csv.writer(data, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL).writerows(rows)
+                zip_file.writestr(region_file, data.getvalue().encode("cp1250"))
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS bytes
+    return usage / 1024 ** 2 if sys.platform == "darwin" else usage / 1024
+
+
+def git_commit():
+    """Current commit of the repository, None if it can not be found"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_pipeline(n_rows, n_archives=2, workdir=None, output="benchmark.json", seed=0):
+    """Time stages of the whole pipeline on synthetic archives, from parsing data to rendering figures.
+    Wall time and peak RSS after every stage (peak of the whole process so far) are saved to a JSON file.
+
+    Arguments:
+    n_rows -- number of rows of every region in every archive
+
+    Keyword arguments:
+    n_archives -- number of generated archives, at most 5 (default 2)
+    workdir -- directory for generated data and figures, it is kept if given (default temporary directory)
+    output -- JSON file with results (default benchmark.json)
+    seed -- random seed (default 0)
+
+    Returns:
+    Dictionary with results
+    """
+    import matplotlib
+    matplotlib.use("Agg") # Figures are only saved
+
+    import pandas as pd
+    import analysis
+    import geo
+    import get_stat
+    import mercantile
+    import tiles
+    from doc import doc
+    from PIL import Image
+
+    output = os.path.abspath(output)
+    keep = workdir is not None
+    workdir = os.path.abspath(workdir) if keep else tempfile.mkdtemp(prefix="izv_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir) # DataDownloader and figures use relative paths
+
+    stages = list()
+
+    def stage(name, func, *args, **kwargs):
+        result, seconds = timed(lambda: func(*args, **kwargs))
+        stages.append({"stage": name, "seconds": round(seconds, 4), "peak_rss_mb": round(peak_rss(), 1)})
+        print(f"{name}: {seconds:.2f} s", file=sys.stderr)
+        return result
+
+    try:
+        downloader = dl.DataDownloader()
+        downloader.data_archives = dl.LEGACY_ARCHIVES[:n_archives]
+        regions = list(downloader.region_files)
+
+        # Generated archives stand in for downloading them
+        stage("generate", write_archives, downloader.folder, downloader.data_archives, downloader.region_files,
+              downloader.data_types, n_rows, seed, downloader.col_headers)
+
+        parsed = stage("parse", lambda: {archive: downloader.parse_regions(regions, archives=[archive]) for archive in downloader.data_archives})
+
+        stage("cache_write", lambda: [downloader.save_cache(region, archive, parsed[archive][region])
+                                      for archive in downloader.data_archives for region in regions])
+
+        downloader = dl.DataDownloader()
+        downloader.data_archives = dl.LEGACY_ARCHIVES[:n_archives]
+        parts = stage("cache_read", lambda: [downloader.load_cache(region, archive) for region in regions for archive in downloader.data_archives])
+
+        np_data = stage("aggregate", downloader.aggregate, parts)
+        data_source = (downloader.col_headers, np_data)
+
+        stage("select", downloader.select, ["p1", "p13a"], {"region": ["MSK"], "year": dl.archive_year(downloader.data_archives[-1])})
+
+        # Dataframe in the format of accidents.pkl.gz
+        def make_dataframe():
+            df = pd.DataFrame({header: downloader.decode(header, col) if header in downloader.vocabulary else col
+                               for header, col in zip(downloader.col_headers, np_data)})
+            df["p2a"] = df["p2a"].dt.strftime("%Y-%m-%d")
+            df.to_pickle("accidents.pkl.gz", "gzip")
+
+        stage("dataframe_write", make_dataframe)
+        stage("dataframe_build", analysis.get_dataframe, "accidents.pkl.gz")
+        df = stage("dataframe_load", analysis.get_dataframe, "accidents.pkl.gz")
+
+        stage("render_crashes", get_stat.plot_stat, data_source, workdir)
+        cubes = stage("cubes", analysis.build_cubes, df)
+        stage("render_conseq", analysis.plot_conseq, df, "conseq.pdf", cubes=cubes)
+        stage("render_damage", analysis.plot_damage, df, "damage.pdf", cubes=cubes)
+        stage("render_surface", analysis.plot_surface, df, "surface.pdf", cubes=cubes)
+        stage("render_weather", doc.plot_weather, df.copy(), "fig.pdf")
+
+        gdf = stage("make_geo", geo.make_geo, df.copy())
+        px, py = stage("project", geo.project, gdf)
+
+        # Local tiles, so that maps are rendered without network
+        west, south = mercantile.lnglat(px.min(), py.min())
+        east, north = mercantile.lnglat(px.max(), py.max())
+        zoom = tiles.zoom_level(px.max() - px.min())
+        tile_png = io.BytesIO()
+        Image.new("RGB", (256, 256), (230, 230, 230)).save(tile_png, "PNG")
+        with tiles.get_cache() as cache:
+            cache.put({tile: tile_png.getvalue() for tile in mercantile.tiles(west, south, east, north, range(max(zoom - 1, 0), zoom + 3))})
+
+        stage("render_geo", geo.plot_geo, gdf, "geo1.png")
+        stage("render_geo_density", geo.plot_geo, gdf, "geo1_density.png", render="density")
+        stage("render_cluster", geo.plot_cluster, gdf, "geo2.png")
+    finally:
+        os.chdir(cwd)
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "rows_per_region": n_rows,
+        "archives": n_archives,
+        "regions": len(regions),
+        "total_rows": len(np_data[0]),
+        "stages": stages,
+    }
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    return results
+
+
+class ArchiveRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file server answering conditional (ETag) and range requests like the original data source,
+    requests for files are recorded as (path, status) in class attribute requests. Used by tests/test_download.py as well."""
+
+    requests = list()
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path): # Index page
+            return super().send_head()
+
+        stat = os.stat(path)
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        start = 0
+
+        if self.headers.get("If-None-Match") == etag:
+            return self.respond(304, etag)
+        if self.headers.get("Range") and self.headers.get("If-Range", etag) == etag:
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= stat.st_size:
+                return self.respond(416, etag, {"Content-Range": f"bytes */{stat.st_size}"})
+
+        f = open(path, "rb")
+        f.seek(start)
+        headers = {"Content-Length": str(stat.st_size - start), "Last-Modified": self.date_time_string(int(stat.st_mtime))}
+        if start:
+            headers["Content-Range"] = f"bytes {start}-{stat.st_size - 1}/{stat.st_size}"
+
+        self.respond(206 if start else 200, etag, headers)
+        return f
+
+    def respond(self, status, etag, headers=None):
+        """Send status and headers of a response to request for a file"""
+        ArchiveRequestHandler.requests.append((os.path.basename(self.path), status))
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+
+def bench_download(n_rows=1000, n_archives=2, seed=0):
+    """Time downloading generated archives from a local HTTP server. Archives are downloaded, revalidated
+    without changes and resumed from partial files. Downloaded files are checked by tests/test_download.py.
+
+    Keyword arguments:
+    n_rows -- number of rows of every region in every archive (default 1000)
+    n_archives -- number of generated archives, at most 5 (default 2)
+    seed -- random seed (default 0)
+    """
+    workdir = tempfile.mkdtemp(prefix="izv_download_")
+    mirror = os.path.join(workdir, "mirror")
+    cwd = os.getcwd()
+
+    downloader = dl.DataDownloader()
+    archives = dl.LEGACY_ARCHIVES[:n_archives]
+    write_archives(mirror, archives, downloader.region_files, downloader.data_types, n_rows, seed, downloader.col_headers)
+
+    handler = lambda *args, **kwargs: ArchiveRequestHandler(*args, directory=mirror, **kwargs)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def download(name):
+        ArchiveRequestHandler.requests.clear()
+        downloader = dl.DataDownloader(f"http://127.0.0.1:{server.server_port}/")
+        _, seconds = timed(downloader.download_archives, archives)
+        print(f"{name}: {seconds:.2f} s, requests {sorted(ArchiveRequestHandler.requests)}")
+
+    try:
+        os.chdir(workdir) # DataDownloader uses relative paths
+
+        download("first")
+        download("unchanged")
+
+        # Interrupted download, only a half of the archive was written
+        with open(os.path.join(mirror, archives[0]), "rb") as f:
+            data = f.read()
+        os.remove(os.path.join("data", archives[0]))
+        with open(os.path.join("data", f"{archives[0]}.part"), "wb") as f:
+            f.write(data[:len(data) // 2])
+        download("resumed")
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def tile_png(tile):
+    """PNG of a generated tile, colour of the tile is given by its coordinates (tile_colour)"""
+    from PIL import Image
+
+    data = io.BytesIO()
+    Image.new("RGB", (256, 256), tile_colour(tile)).save(data, "PNG")
+    return data.getvalue()
+
+
+def tile_colour(tile):
+    """Colour of a generated tile"""
+    return (tile.x % 256, tile.y % 256, tile.z * 10)
+
+
+def bench_tiles(zoom=12):
+    """Time the tile cache and basemaps on locally generated tiles, so that no tiles are downloaded.
+    Stored tiles and basemaps are checked by tests/test_tiles.py.
+
+    Keyword arguments:
+    zoom -- zoom level of generated tiles (default 12)
+    """
+    import matplotlib
+    matplotlib.use("Agg") # Figures are only drawn
+
+    import matplotlib.pyplot as plt
+    import mercantile
+    import tiles
+
+    workdir = tempfile.mkdtemp(prefix="izv_tiles_")
+    # Unreachable source, tiles are only read from the cache
+    source = {"name": "local", "url": "http://127.0.0.1:9/{z}/{x}/{y}.png", "attribution": "Generated tiles"}
+    area = list(mercantile.tiles(*tiles.CZ_BOUNDS[:2], tiles.CZ_BOUNDS[0] + 0.3, tiles.CZ_BOUNDS[1] + 0.2, zoom))
+
+    try:
+        with tiles.get_cache(source, workdir, max_bytes=None, offline=True) as cache:
+            data, seconds = timed(lambda: {tile: tile_png(tile) for tile in area})
+            _, put_seconds = timed(cache.put, data)
+            _, get_seconds = timed(cache.get, area)
+            print(f"tiles: {len(area)}, generate {seconds:.2f} s, put {put_seconds:.2f} s, get {get_seconds:.2f} s")
+
+            # Basemap of the middle of the area, drawn only from cached tiles
+            bounds = mercantile.xy_bounds(area[len(area) // 2])
+            width = bounds.right - bounds.left
+            fig, ax = plt.subplots()
+            ax.set(xlim=(bounds.left, bounds.right + width * 2), ylim=(bounds.bottom, bounds.top + width))
+            _, seconds = timed(tiles.add_basemap, ax, zoom, source, cache)
+            print(f"add_basemap: {seconds:.2f} s")
+            plt.close(fig)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_startup(repeat=5):
+    """Measure wall time of starting entry points and importing modules, each in a new interpreter
+
+    Keyword arguments:
+    repeat -- number of runs of every command, the fastest and the median run are reported (default 5)
+
+    Returns:
+    Dictionary mapping commands to tuples of the fastest and the median time in seconds
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    commands = {
+        "python": ["-c", "pass"],
+        "cli.py --help": [os.path.join(root, "cli.py"), "--help"],
+        "cli.py plot --help": [os.path.join(root, "cli.py"), "plot", "--help"],
+    }
+    for module in ["download", "get_stat", "analysis", "geo"]:
+        commands[f"import {module}"] = ["-c", f"import {module}"]
+
+    results = dict()
+    for name, args in commands.items():
+        run = lambda: subprocess.run([sys.executable, *args], cwd=root, check=True, stdout=subprocess.DEVNULL)
+        times = sorted(timed(run)[1] for _ in range(repeat))
+        results[name] = (times[0], times[len(times) // 2])
+        print(f"{name}: {times[0]:.3f} s (median {times[len(times) // 2]:.3f} s)")
+
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.benchmark == "pipeline":
+        bench_pipeline(args.rows if args.rows is not None else 5000, args.archives, args.workdir, args.output, args.seed)
+    elif args.benchmark == "download":
+        bench_download(args.rows if args.rows is not None else 1000, args.archives, args.seed)
+    elif args.benchmark == "tiles":
+        bench_tiles()
+    elif args.benchmark == "startup":
+        bench_startup(args.repeat)
+    else:
+        bench_build_columns(args.rows if args.rows is not None else 500000, args.seed)
@@ -0,0 +1,144 @@
+"""IZV project command line interface
+
+This module runs steps of the project from a single entry point:
+download -- download data archives
+build-cache -- parse data archives into cache directories
+stats -- print number of crashes per year and region, optionally plot them
+plot -- render one figure (conseq, damage, surface, geo or cluster)
+Modules needed by a step are imported only when the step runs, so --help and steps working
+with data only do not pay for importing pandas, matplotlib and the geographic libraries.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import argparse
+import os
+import sys
+
+# Figures rendered by plot: name -> (module, function, default output file)
+PLOTS = {
+    "conseq": ("analysis", "plot_conseq", "conseq.pdf"),
+    "damage": ("analysis", "plot_damage", "damage.pdf"),
+    "surface": ("analysis", "plot_surface", "surface.pdf"),
+    "geo": ("geo", "plot_geo", "geo1.png"),
+    "cluster": ("geo", "plot_cluster", "geo2.png"),
+}
+
+
+def parse_arguments(argv: list = None):
+    """Parse command line arguments."""
+
+    # Options of steps using DataDownloader
+    source = argparse.ArgumentParser(add_help=False)
+    source.add_argument("--url", help="URL of data archives, e.g. a local mirror", default="https://ehw.fit.vutbr.cz/izv/")
+    source.add_argument("--folder", help="Folder with data archives and cache directories", default="data")
+    source.add_argument("--update", help="Find data archives on the index page first", action="store_true")
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    download_parser = subparsers.add_parser("download", help="Download data archives", parents=[source])
+    download_parser.add_argument("--workers", help="Number of archives downloaded at once", type=int, default=4)
+
+    cache_parser = subparsers.add_parser("build-cache", help="Parse data archives into cache directories", parents=[source])
+    cache_parser.add_argument("regions", help="Region acronyms (default all regions)", nargs="*")
+    cache_parser.add_argument("--workers", help="Number of parsing processes", type=int)
+
+    stats_parser = subparsers.add_parser("stats", help="Print number of crashes per year and region", parents=[source])
+    stats_parser.add_argument("regions", help="Region acronyms (default all regions)", nargs="*")
+    stats_parser.add_argument("--fig_location", help="Save chart crashes.pdf into this folder")
+    stats_parser.add_argument("--show_figure", help="Show chart in separate window", action="store_true")
+
+    plot_parser = subparsers.add_parser("plot", help="Render a figure")
+    plot_parser.add_argument("figure", help="Figure to render", choices=list(PLOTS))
+    plot_parser.add_argument("--data", help="File containing the data", default="accidents.pkl.gz")
+    plot_parser.add_argument("--output", help="Output file (default conseq.pdf, damage.pdf, surface.pdf, geo1.png or geo2.png)")
+    plot_parser.add_argument("--show_figure", help="Show figure in separate window", action="store_true")
+
+    return parser.parse_args(argv)
+
+
+def get_downloader(args):
+    """Create DataDownloader from options of a step, archives are found on the index page if requested"""
+    import download as dl
+
+    downloader = dl.DataDownloader(args.url, args.folder)
+    if args.update:
+        downloader.update_archives()
+
+    return downloader
+
+
+def download(args):
+    """Download data archives which are missing or changed on the server"""
+    downloader = get_downloader(args)
+    downloaded = downloader.download_archives(workers=args.workers)
+
+    print(f"Downloaded archives: {', '.join(downloaded) if downloaded else 'none'}", file=sys.stderr)
+
+
+def build_cache(args):
+    """Parse data archives into cache directories, archives are downloaded if they are missing"""
+    downloader = get_downloader(args)
+    _, np_data = downloader.get_list(args.regions or None, args.workers)
+
+    print(f"Cached crashes: {len(np_data[0])}", file=sys.stderr)
+
+
+def stats(args):
+    """Print number of crashes per year and region as a table"""
+    import get_stat
+
+    downloader = get_downloader(args)
+    data_source = downloader.get_list(args.regions or None)
+    years, regions, counts = get_stat.count_crashes(data_source)
+
+    print("year " + " ".join(f"{region:>6}" for region in regions))
+    for year, row in zip(years, counts):
+        print(f"{year:<4} " + " ".join(f"{count:>6}" for count in row))
+
+    if args.fig_location is not None or args.show_figure:
+        use_agg(args.show_figure)
+        get_stat.plot_stat(data_source, args.fig_location, args.show_figure)
+
+
+def plot(args):
+    """Render one figure from the dataframe"""
+    module, function, output = PLOTS[args.figure]
+
+    if not os.path.isfile(args.data):
+        print(f"ERROR: File '{args.data}' not found. Quitting.", file=sys.stderr)
+        sys.exit(1)
+
+    use_agg(args.show_figure)
+
+    import importlib
+    import analysis
+
+    data = analysis.get_dataframe(args.data)
+    if module == "geo":
+        import geo
+        data = geo.make_geo(data)
+
+    getattr(importlib.import_module(module), function)(data, args.output or output, args.show_figure)
+
+
+def use_agg(show_figure: bool):
+    """Use non-interactive matplotlib backend if figures are only saved, interactive backends are slower to import"""
+    if not show_figure:
+        import matplotlib
+        matplotlib.use("Agg")
+
+
+# Subcommand -> function running it
+COMMANDS = {"download": download, "build-cache": build_cache, "stats": stats, "plot": plot}
+
+
+def main(argv: list = None):
+    """Run subcommand given by command line arguments"""
+    args = parse_arguments(argv)
+    COMMANDS[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,11 @@ __author__ = "Martin Kostelník (xkoste12)"
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
-import numpy as np
+
+try:
+    from . import stats
+except ImportError: # Run as a script from doc folder
+    import stats
 
 
 def get_df() -> pd.DataFrame:
@@ -21,11 +25,12 @@ def get_df() -> pd.DataFrame:
     return pd.read_pickle("accidents.pkl.gz")
 
 
-def plot_weather(df: pd.DataFrame):
+def plot_weather(df: pd.DataFrame, fig_location: str = "fig.pdf"):
     """Plot chart containing car crashes during different weather situations
 
     Keyword arguments:
     df -- existing dataframe containing car crashes data
+    fig_location -- plot will be saved to this file (default fig.pdf)
     """
     plt.figure(figsize=(12, 5))
     ax = plt.gca()
@@ -43,55 +48,44 @@ def plot_weather(df: pd.DataFrame):
 
     plt.tight_layout()
 
-    plt.savefig("fig.pdf")
+    plt.savefig(fig_location)
 
 
-def create_table(df: pd.DataFrame):
+def create_table(df: pd.DataFrame, table: pd.DataFrame = None):
     """Creates table containing data per weather per year and
     print it to standard output in LaTeX format with tabular environment
 
     Keyword arguments:
     df -- existing dataframe containing car crashes data
+    table -- table computed by stats.weather_table, computed from df if not given (default None)
     """
-    print(r"\begin{tabular}{ |c|c|c|c|c|c|c|c|c| }")
-    print(r"\hline")
-    print(r"Rok & Jiné & Nezatížené & Mlha & Slabý déšť & Déšť & Sněžení & Náledí & Nárazový vítr \\")
-    print(r"\hline")
-
-    years = ["2016", "2017", "2018", "2019", "2020"]
-
-    for year in years:
-        print(f"{year} & ", end='')
-
-        for val in np.sort(df["p18"].unique()):
-            count = df[df.p2a.str.startswith(year)]["p18"].value_counts()[val]
+    if table is None:
+        table = stats.weather_table(df)
 
-            if val != 7:
-                print(f"{count} & ", end='')
-            else:
-                print(f"{count} \\\\")
+    print(stats.table_to_latex(table))
 
-        print(r"\hline")
 
-    print(r"\end{tabular}")
-
-
-def print_stats(df: pd.DataFrame):
+def print_stats(df: pd.DataFrame, table: pd.DataFrame = None):
     """Prints stats used in doc.pdf
 
     Keyword arguments:
     df -- existing dataframe containing car crashes data
+    table -- table computed by stats.weather_table, computed from df if not given (default None)
     """
-    print(f"Celkem nehod: {len(df)}")
+    if table is None:
+        table = stats.weather_table(df)
+
+    summary = stats.summary(table)
 
-    crashes_snow = (df["p18"].value_counts()[5] + df["p18"].value_counts()[6]) / len(df) * 100
-    print(f"Nehody při sněžení/náledí: {crashes_snow:.02f} %")
-    print(f"Počet nehod při ztížených podmínkách: {len(df[df.p18 != 1])}")
-    print(f"Počet nehod při neztížených podmínkách: {len(df[df.p18 == 1])}")
+    print(f"Celkem nehod: {summary['total']}")
+    print(f"Nehody při sněžení/náledí: {summary['snow_pct']:.02f} %")
+    print(f"Počet nehod při ztížených podmínkách: {summary['bad']}")
+    print(f"Počet nehod při neztížených podmínkách: {summary['good']}")
 
 
 if __name__ == "__main__":
     df = get_df()
     plot_weather(df)
-    create_table(df)
-    print_stats(df)
+    table = stats.weather_table(df)
+    create_table(df, table)
+    print_stats(df, table)
@@ -0,0 +1,75 @@
+"""IZV project part 3.3 statistics
+
+This module computes statistics about car crashes during different weather situations used in doc.pdf.
+All statistics are derived from one contingency table, which is computed in a single grouped pass.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import pandas as pd
+
+# Names of weather situations (column p18) used in the table
+WEATHER_NAMES = {0: "Jiné", 1: "Nezatížené", 2: "Mlha", 3: "Slabý déšť", 4: "Déšť", 5: "Sněžení", 6: "Náledí", 7: "Nárazový vítr"}
+
+
+def weather_table(df: pd.DataFrame) -> pd.DataFrame:
+    """Count crashes per year and weather situation
+
+    Keyword arguments:
+    df -- existing dataframe containing car crashes data
+
+    Returns:
+    Dataframe with years as index and weather codes (p18) as columns, only years and codes found in data are present.
+    Crashes without date or weather are counted in row or column <NA>, so the table sums to the number of crashes.
+    """
+    if "date" in df:
+        dates = df["date"]
+    else:
+        dates = pd.to_datetime(df["p2a"])
+
+    years = dates.dt.year.astype("Int64").rename("year")
+    weather = df["p18"].astype("Int64").rename("p18")
+    table = df.groupby([years, weather], dropna=False).size().unstack("p18", fill_value=0)
+
+    return table.sort_index().sort_index(axis=1)
+
+
+def summary(table: pd.DataFrame) -> dict:
+    """Compute summary statistics from table created by weather_table
+
+    Keyword arguments:
+    table -- crashes per year and weather situation
+
+    Returns:
+    Dictionary with total number of crashes, percentage of crashes during snowfall or ice
+    and numbers of crashes during bad and good conditions
+    """
+    per_weather = table.sum(axis=0)
+    total = int(per_weather.sum())
+    good = int(per_weather.get(1, 0))
+
+    return {
+        "total": total,
+        "snow_pct": (per_weather.get(5, 0) + per_weather.get(6, 0)) / total * 100 if total else 0.0,
+        "bad": total - good,
+        "good": good,
+    }
+
+
+def table_to_latex(table: pd.DataFrame) -> str:
+    """Render table created by weather_table as LaTeX tabular environment, crashes without date or weather are left out"""
+    table = table.loc[table.index.notna(), table.columns.notna()]
+    lines = [
+        f"\\begin{{tabular}}{{ |{'c|' * (len(table.columns) + 1)} }}",
+        r"\hline",
+        " & ".join(["Rok"] + [WEATHER_NAMES.get(code, str(code)) for code in table.columns]) + r" \\",
+        r"\hline",
+    ]
+
+    for year, counts in table.iterrows():
+        lines.append(" & ".join([str(year)] + [str(count) for count in counts]) + r" \\")
+        lines.append(r"\hline")
+
+    lines.append(r"\end{tabular}")
+
+    return "\n".join(lines)
@@ -7,35 +7,368 @@ __author__ = "Martin Kostelník (xkoste12)"
 
 import os
 import sys
-import requests
+import contextlib
 import csv
 import pickle
 import gzip
+import warnings
+import itertools
+import re
+import tempfile
+import threading
+import shutil
+import json
 from io import TextIOWrapper
-from bs4 import BeautifulSoup
+from collections import OrderedDict
 from urllib.parse import urljoin
+from email.utils import formatdate
 from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
+import metrics
+
+ERROR_VALUE = -9999 # Value used for cells which could not be converted
+CACHE_VERSION = 2 # Version of cache directory format, cache directories with other versions are converted
+
+TIMEOUT = (10, 60) # Connect and read timeouts of HTTP requests in seconds, a stalled server raises an error instead of hanging
+
+# Archives used by previous versions, which cached whole regions instead of partitions
+LEGACY_ARCHIVES = ["datagis2016.zip", "datagis-rok-2017.zip", "datagis-rok-2018.zip", "datagis-rok-2019.zip", "datagis-09-2020.zip"]
+
+# Names of data archives, e.g. datagis2016.zip, datagis-rok-2017.zip (whole year) or datagis-09-2020.zip (January - September)
+ARCHIVE_PATTERN = re.compile(r"^datagis-?(?:rok-)?(?:(\d{2})-)?(\d{4})\.zip$")
+
+# Numbers accepted by to_numeric, the same numbers int() and float() accept (digits may be separated by underscores)
+DIGITS = r"[0-9](?:_?[0-9])*"
+NUMBER_PATTERNS = {
+    "int": rf"[+-]?{DIGITS}",
+    "float": rf"[+-]?(?:(?:{DIGITS}(?:\.(?:{DIGITS})?)?|\.{DIGITS})(?:[eE][+-]?{DIGITS})?|(?i:nan|inf|infinity))",
+}
+
+
+def numeric_lines(text, dtype):
+    """Find lines of text (cells of a column joined by to_numeric) which are numbers accepted by NUMBER_PATTERNS.
+    Lines made of digits, a sign at the start and (in float columns) one decimal point are found at once
+    by masks over bytes of the text, only the other lines are matched one by one.
+
+    Arguments:
+    text -- ASCII text, cells of a column joined by newlines
+    dtype -- target data type ("int" or "float")
+
+    Returns:
+    Returns a tuple of two elements. First being a boolean ndarray marking valid lines, the second being
+    the text of valid lines only. Returns None if the text is not ASCII or an integer may not fit into int64.
+    """
+
+    try:
+        b = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    except UnicodeEncodeError:
+        return None
+
+    newlines = np.flatnonzero(b == ord("\n"))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(b)]))
+
+    lengths = ends - starts
+    if dtype == "int" and lengths.max() >= 19: # np.fromstring does not detect overflow like int()
+        return None
+
+    # Characters other than digits, newlines, signs at the start of lines and decimal points in float columns
+    point = (b == ord(".")) if dtype == "float" else np.zeros(shape=(len(b)), dtype=bool)
+    other = ~(((b >= ord("0")) & (b <= ord("9"))) | point | (b == ord("\n")))
+
+    signed = np.zeros(shape=(len(starts)), dtype=bool)
+    first = b[starts[lengths > 0]]
+    signed[lengths > 0] = (first == ord("-")) | (first == ord("+"))
+    other[starts[signed]] = False
+
+    # Line of a character is the number of newlines before it
+    has_other = np.zeros(shape=(len(starts)), dtype=bool)
+    has_other[np.searchsorted(newlines, np.flatnonzero(other))] = True
+    points = np.bincount(np.searchsorted(newlines, np.flatnonzero(point)), minlength=len(starts))
+
+    # Without other characters, the line is a number if it has at most one decimal point and at least one digit
+    valid = ~has_other & (points <= 1) & (lengths - points - signed > 0)
+
+    # Remaining non-empty lines may still be numbers, e.g. surrounded by spaces or with an exponent
+    pattern = re.compile(rf"\s*{NUMBER_PATTERNS[dtype]}\s*")
+    for i in np.flatnonzero(~valid & (ends > starts)):
+        valid[i] = pattern.fullmatch(text, starts[i], ends[i]) is not None
+
+    if valid.all():
+        return valid, text
+
+    # Keep bytes of valid lines together with their newlines
+    keep = np.repeat(valid, ends - starts + 1)[:len(b)]
+    return valid, b[keep].tobytes().decode("ascii")
+
+
+def to_numeric(col, dtype):
+    """Convert a column of strings to a numeric array. Decimal commas are accepted in float columns.
+    Every cell is checked by the same rule (NUMBER_PATTERNS), so the value of a cell does not depend on other cells.
+
+    Arguments:
+    col -- sequence of strings
+    dtype -- target data type ("int" or "float")
+
+    Returns:
+    Returns a new ndarray of type dtype. Invalid cells are set to ERROR_VALUE.
+    """
+
+    text = "\n".join(col)
+    if dtype == "float":
+        text = text.replace(',', '.')
+
+    # Numbers with underscores are not parsed by np.fromstring like by int(), cells with newlines can not be joined into lines
+    if text.count("\n") == len(col) - 1 and "_" not in text:
+        lines = numeric_lines(text, dtype)
+
+        if lines is not None:
+            # Valid cells are parsed at once
+            valid, text = lines
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning) # Numpy warns when text can not be parsed to the end
+                values = np.fromstring(text, dtype=dtype, sep="\n") if len(text) else np.empty(shape=(0), dtype=dtype)
+
+            if len(values) == valid.sum():
+                if len(values) == len(col):
+                    return values
+
+                np_col = np.full(shape=(len(col)), fill_value=ERROR_VALUE, dtype=dtype)
+                np_col[valid] = values
+                return np_col
+
+    # Cells are checked one by one and converted using the same conversion as int() and float()
+    col = np.array([cell.replace(',', '.') for cell in col] if dtype == "float" else col, dtype=str)
+    pattern = re.compile(rf"\s*{NUMBER_PATTERNS[dtype]}\s*")
+    valid = np.fromiter(map(bool, map(pattern.fullmatch, col.tolist())), dtype=bool, count=len(col))
+
+    np_col = np.full(shape=col.shape, fill_value=ERROR_VALUE, dtype=dtype)
+    for i in np.flatnonzero(valid):
+        try:
+            np_col[i] = col[i]
+        except OverflowError: # Integer does not fit
+            pass
+
+    return np_col
+
+
+def archive_year(archive):
+    """Year of data in archive, None if the archive name is not recognized"""
+
+    match = ARCHIVE_PATTERN.match(archive)
+    return int(match.group(2)) if match else None
+
+
+def select_archives(archives):
+    """Select the most complete archive of every year. Yearly archives are preferred, otherwise
+    the archive with the latest month is selected.
+
+    Arguments:
+    archives -- iterable of archive names
+
+    Returns:
+    Returns a list of archive names sorted by year.
+    """
+
+    best = dict() # Year -> (month, archive)
+
+    for archive in archives:
+        match = ARCHIVE_PATTERN.match(archive)
+        if match is None:
+            continue
+
+        month = int(match.group(1)) if match.group(1) else 13 # Yearly archive contains the whole year
+        year = int(match.group(2))
+
+        if year not in best or month > best[year][0]:
+            best[year] = (month, archive)
+
+    return [best[year][1] for year in sorted(best)]
+
+
+def narrow_ints(col, dtype):
+    """Convert integer array to dtype, or to the narrowest wider integer type which can hold all values
+
+    Arguments:
+    col -- ndarray of integers
+    dtype -- narrowest allowed data type
+
+    Returns:
+    Returns an ndarray of integers.
+    """
+
+    for t in ["int8", "int16", "int32", "int64"]:
+        if np.dtype(t).itemsize < np.dtype(dtype).itemsize:
+            continue
+
+        info = np.iinfo(t)
+        if len(col) == 0 or (info.min <= col.min() and col.max() <= info.max):
+            return col.astype(t)
+
+    return col.astype("int64")
+
+
+def to_dates(col):
+    """Convert a column of ISO formatted strings to dates
+
+    Arguments:
+    col -- sequence of strings
+
+    Returns:
+    Returns a new ndarray of type datetime64[D]. Invalid cells are set to NaT.
+    """
+
+    try:
+        return np.array(col, dtype="datetime64[D]") # Empty strings are parsed as NaT
+    except ValueError:
+        pass
+
+    # Some cells are not dates, convert them one by one
+    np_col = np.full(shape=(len(col)), fill_value=np.datetime64("NaT"), dtype="datetime64[D]")
+    for i, cell in enumerate(col):
+        try:
+            np_col[i] = cell
+        except ValueError:
+            pass
+
+    return np_col
+
+
+def narrow_strings(col, max_width=64):
+    """Narrow string array to the width of its longest value
+
+    Arguments:
+    col -- ndarray of strings
+
+    Keyword arguments:
+    max_width -- longer values are truncated to this width (default 64)
+
+    Returns:
+    Returns an ndarray with the narrowest string data type which can hold all values.
+    """
+
+    width = int(np.char.str_len(col).max()) if len(col) else 1
+    return col.astype(f"U{min(max(width, 1), max_width)}")
+
+
+class LRUCache:
+    """Thread-safe mapping of keys to ndarrays (or nested lists of them) with limited total size of arrays.
+    Least recently used entries are evicted when the size is exceeded.
+    """
+
+    def __init__(self, max_bytes=None):
+        """Initialize empty cache
+
+        Keyword arguments:
+        max_bytes -- maximal total size of cached arrays in bytes, None means unlimited (default None)
+        """
+
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # Key -> (value, size), least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key, default=None):
+        """Get cached value and mark it as recently used, default is returned if key is not cached"""
+
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        """Cache value, least recently used entries are evicted if the cache is too large.
+        Values larger than the whole cache are not cached.
+        """
+
+        size = array_bytes(value)
+
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size)
+            self.nbytes += size
+
+            while self.max_bytes is not None and self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+                metrics.count("cache.evictions")
+
+    def clear(self):
+        """Remove all entries"""
+
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Statistics of the cache
+
+        Returns:
+        Returns a dictionary with number of entries, their size in bytes, size limit, hits, misses and evictions.
+        """
+
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.nbytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+def array_bytes(value):
+    """Total size of ndarrays in value, which is an ndarray or a (nested) list or tuple of them"""
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+
+    return sum(array_bytes(item) for item in value)
+
 
 class DataDownloader:
     """This class implements downloading car accidents data and its parsing."""
     
-    def __init__(self, url="https://ehw.fit.vutbr.cz/izv/", folder="data", cache_filename="data_{}.pkl.gz"):
+    def __init__(self, url="https://ehw.fit.vutbr.cz/izv/", folder="data", cache_filename="data_{}.pkl.gz", cache_dirname="data_{}", max_cache_bytes=None):
         """Initialize DataDownloader instance
 
         Keyword arguments:
         url -- Data will be downloaded from this URL. (default https://ehw.fit.vutbr.cz/izv/)
         folder -- Data will be saved in this folder. Use absolute paths or multiple folders at your own risk (default data)
-        cache_filename -- Name of caching files. Use without {} or with mupliple brackets at your own risk (default data_{}.pkl.gz)
+        cache_filename -- Name of old caching files, which are only read if there is no cache directory. Use without {} or with mupliple brackets at your own risk (default data_{}.pkl.gz)
+        cache_dirname -- Name of caching directories, each column is stored in its own .npy file. Use without {} or with mupliple brackets at your own risk (default data_{})
+        max_cache_bytes -- Memory budget of regions and aggregated data kept in memory, least recently used data are evicted (they stay in cache directories). None means unlimited (default None)
         """
 
         self.folder = folder
         self.url = url
         self.cache_filename = cache_filename
+        self.cache_dirname = cache_dirname
 
-        self.data_archives = ["datagis2016.zip", "datagis-rok-2017.zip", "datagis-rok-2018.zip", "datagis-rok-2019.zip", "datagis-09-2020.zip"]
+        self.data_archives = list(LEGACY_ARCHIVES) # Use update_archives to find current archives
         self.headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.77 Safari/537.36"}
-        self.region_cache = dict()
+        # Partitions of regions (keys are region acronyms) and aggregated data of region sets returned by get_list (keys are tuples of acronyms)
+        self.region_cache = LRUCache(max_cache_bytes)
+        self.lock = threading.RLock() # Vocabularies are shared by threads using this instance
+        self.region_locks = dict() # Region -> lock held while partitions of the region are created, see lock_regions
+        self.links = None # Links to data archives, found when they are needed for the first time
 
         self.col_headers = ["p1", "p36", "p37", "p2a", "weekday(p2a)", "p2b", "p6", "p7", "p8", "p9", "p10",
                             "p11", "p12", "p13a", "p13b", "p13c", "p14", "p15", "p16", "p17", "p18", "p19",
@@ -44,13 +377,15 @@ class DataDownloader:
                             "p57", "p58", "a", "b", "d", "e", "f", "g", "h", "i", "j", "k", "l", "n",
                             "o", "p", "q", "r", "s", "t", "p5a", "region"]
 
-        self.data_types = ["int", "int", "int", "U64", "int", "int", "int", "int", "int", "int",
-                           "int", "int", "int", "int", "int", "int", "int", "int", "int", "int", 
-                           "int", "int", "int", "int", "int", "int", "int", "int", "int", "int", 
-                           "int", "int", "int", "int", "U64", "int", "int", "int", "int", "int", 
-                           "int", "int", "int", "int", "int", "float", "float", "float", "float", "float", 
-                           "float", "U64", "U64", "U64", "U64", "U64", "U64", "float", "U64", "U64", 
-                           "U64", "int", "U64", "int"] # region data type is missing as it is added later
+        # Data types of columns, integer types are the narrowest ones used, columns are widened when values do not fit,
+        # category columns contain codes into self.vocabulary and str columns contain strings
+        self.data_types = ["int64", "int8", "int32", "datetime64[D]", "int8", "int16", "int8", "int8", "int8", "int8",
+                           "int8", "int8", "int16", "int8", "int8", "int8", "int32", "int8", "int8", "int8",
+                           "int8", "int8", "int8", "int8", "int8", "int8", "int8", "int8", "int8", "int8",
+                           "int8", "int8", "int8", "int16", "category", "int8", "int8", "int8", "int8", "int8",
+                           "int16", "int32", "int8", "int8", "int8", "float64", "float64", "float64", "float64", "float64",
+                           "float64", "category", "category", "category", "category", "category", "str", "float64", "category", "category",
+                           "category", "int32", "category", "int8"] # region data type is missing as it is added later, it is always a category
 
         self.region_files = { "PHA": "00.csv",    # Praha
                               "STC": "01.csv",    # Středočeský kraj
@@ -67,6 +402,11 @@ class DataDownloader:
                               "LBK": "18.csv",    # Liberecký kraj
                               "KVK": "19.csv", }  # Karlovarský kraj
 
+        # Values of category columns, codes are indices into these lists. New values are only ever appended,
+        # so codes stay valid for the whole life of the instance
+        self.vocabulary = {"region": list(self.region_files)}
+        self.vocabulary_index = {"region": {region: i for i, region in enumerate(self.region_files)}}
+
     def check_folder(self):
         """Checks if data folder exists, if not, creates it"""
 
@@ -77,23 +417,167 @@ class DataDownloader:
                 print("ERROR: could not create directory, quitting", file=sys.stderr)
                 sys.exit(1)
 
+    def archive_links(self):
+        """Find links to all data archives on the index page. The page is downloaded only once per instance.
+
+        Returns:
+        Returns a dictionary mapping archive names to their URLs.
+        """
+
+        if self.links is None:
+            import requests # Imported only when needed, parsing cached data does not use network
+            from bs4 import BeautifulSoup
+
+            r = requests.get(self.url, headers=self.headers, timeout=TIMEOUT) # Get HTML
+            links = BeautifulSoup(r.text, "html.parser").find_all('a') # Find all links
+
+            self.links = {os.path.basename(link["href"]): urljoin(self.url, link["href"])
+                          for link in links if link.get("href", "").endswith(".zip")}
+
+        return self.links
+
     def download_data(self):
         """This method downloads data archives"""
 
+        self.download_archives()
+
+    def download_archives(self, archives=None, workers=4, chunk_size=1048576):
+        """Download data archives concurrently using one pooled session. Archives are streamed to disk in chunks,
+        partially downloaded archives are resumed and archives which did not change on the server are skipped.
+
+        Keyword arguments:
+        archives -- list of archive names (default self.data_archives)
+        workers -- number of archives downloaded at once (default 4)
+        chunk_size -- size of chunks written to disk in bytes (default 1 MB)
+
+        Returns:
+        Returns a list of archive names which were downloaded. Raises ValueError if some archives
+        are not listed on the index page.
+        """
+
         self.check_folder()
 
+        if archives is None:
+            archives = self.data_archives
+
+        links = self.archive_links()
+
+        missing = [archive for archive in archives if archive not in links]
+        if missing:
+            raise ValueError(f"Archives not found on {self.url}: {', '.join(missing)}")
+
+        import requests
+        import requests.adapters
+
         # Create requests session
         with requests.Session() as s:
             s.headers.update(self.headers)
-            response = s.get(self.url) # Get HTML
+            s.mount(self.url, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                downloaded = executor.map(lambda archive: self.download_archive(s, archive, links[archive], chunk_size), archives)
+                return [archive for archive, changed in zip(archives, list(downloaded)) if changed]
+
+    @metrics.timed("download.archive")
+    def download_archive(self, session, archive, url, chunk_size=1048576):
+        """Download a single data archive into data folder.
+
+        The archive is first written to an "archive.part" file, which is resumed using HTTP range request
+        if it already exists. ETag and Last-Modified headers are stored in "archive.meta" file and used to skip
+        archives which did not change since the last download.
+
+        Arguments:
+        session -- requests session used for downloading
+        archive -- archive name
+        url -- archive URL
+
+        Keyword arguments:
+        chunk_size -- size of chunks written to disk in bytes (default 1 MB)
+
+        Returns:
+        Returns True if the archive was downloaded, False if it did not change.
+        """
+
+        path = f"./{self.folder}/{archive}"
+        part_path = f"{path}.part"
+        meta_path = f"{path}.meta"
+
+        meta = dict()
+        if os.path.isfile(meta_path):
+            with open(meta_path, "r") as meta_file:
+                meta = json.load(meta_file)
+
+        validator = meta.get("etag") or meta.get("last_modified")
+        headers = dict()
+
+        if os.path.isfile(path): # Archive is present, download it only if it changed
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            headers["If-Modified-Since"] = meta.get("last_modified") or formatdate(os.path.getmtime(path), usegmt=True)
+        elif os.path.isfile(part_path) and validator: # Resume partial download, unless the archive changed meanwhile
+            headers["Range"] = f"bytes={os.path.getsize(part_path)}-"
+            headers["If-Range"] = validator
+
+        with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+            if r.status_code == 304: # Not modified
+                metrics.count("download.not_modified")
+                return False
+
+            if r.status_code == 416: # Partial file is already complete
+                os.replace(part_path, path)
+                return True
+
+            r.raise_for_status()
+            print(f"DOWNLOADING FILE: \"{archive}\"", file=sys.stderr)
+
+            # Remember validators, so that the download can be resumed or skipped later
+            meta = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+            with open(meta_path, "w") as meta_file:
+                json.dump(meta, meta_file)
+
+            with open(part_path, "ab" if r.status_code == 206 else "wb") as part_file:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    part_file.write(chunk)
+                    metrics.count("download.bytes", len(chunk))
 
-            links = BeautifulSoup(response.text, "html.parser").find_all('a') # Find all links
-        
-            for link in links[3::2]: # We only iterate through zip files (they start on index 3 and then apper once in 2 iterations)
-                if link["href"][5:] in self.data_archives: # Compare link name with the archive we want (we only want relevant archives)
-                    print(f"DOWNLOADING FILE: \"{link['href'][5:]}\"", file=sys.stderr)
-                    zip_file = s.get(urljoin(self.url, link["href"]))
-                    open(link["href"], "wb").write(zip_file.content)
+        os.replace(part_path, path)
+        return True
+
+    def check_archives(self, archives=None):
+        """Checks if data archives are present, downloads those which are missing
+
+        Keyword arguments:
+        archives -- list of archive names (default self.data_archives)
+        """
+
+        self.check_folder()
+
+        if archives is None:
+            archives = self.data_archives
+
+        missing = [archive for archive in archives if not os.path.isfile(f"./{self.folder}/{archive}")]
+
+        if missing: # Data files not present, download them
+            print(f"Data archives missing: {', '.join(missing)}. Downloading now.", file=sys.stderr)
+            self.download_archives(missing)
+
+    def update_archives(self):
+        """Find data archives on the index page and use the most complete archive of every year. Yearly archives
+        are preferred, otherwise the archive with the latest month is used.
+
+        Returns:
+        Returns a list of archive names which were not used before.
+        """
+
+        archives = select_archives(self.archive_links())
+        new = [archive for archive in archives if archive not in self.data_archives]
+
+        if archives != self.data_archives:
+            self.data_archives = archives
+            # Data in memory may be missing partitions of new archives
+            self.region_cache.clear()
+
+        return new
 
     def parse_region_data(self, region):
         """Parse data for a specific region. This method also downloads data archives which are missing.
@@ -106,99 +590,793 @@ class DataDownloader:
         Returns a tuple of two elements. First being column headers (list), the second being a list of ndarrays containing data.
         """
 
-        self.check_folder()
+        return (self.col_headers, self.parse_regions([region])[region])
 
-        # Check if data files are present
-        for archive in self.data_archives:
-            if not os.path.isfile(f"./{self.folder}/{archive}"): # Data file not present, download it
-                print(f"Data archive missing: {archive}. Downloading now.", file=sys.stderr)
-
-                r = requests.get(self.url, headers=self.headers) # Get HTML
-                links = BeautifulSoup(r.text, "html.parser").find_all('a') # Find all links
-
-                for link in links[3::2]:
-                    if archive == link["href"][5:]:
-                        zip_file = requests.get(urljoin(self.url, link["href"]))
-                        open(link["href"], "wb").write(zip_file.content)
-
-        data_list = list()
-
-        # Read archives
-        for archive in self.data_archives:
-            with ZipFile(f"./{self.folder}/{archive}", 'r') as zip:
-                with zip.open(self.region_files[region], 'r') as data_file:
-                    csv_data = csv.reader(TextIOWrapper(data_file, "cp1250"), delimiter=';', quotechar='"')
-                    data_list.extend(list(csv_data))
-
-        np_data = list()
-        l = len(data_list)
-        col_index = 0
-
-        # Create np arrays using correct data type and fill them with data
-        for t in self.data_types:
-            np_data.append(np.ndarray(shape = (l), dtype=t)) # create np array to store data in
-
-            for i in range(l):
-                if t == "U64": # String
-                    np_data[col_index][i] = data_list[i][col_index]
-                else: # Int or Float
-                    try:
-                        if t == "int":
-                            np_data[col_index][i] = data_list[i][col_index]
-                        elif t == "float":
-                            np_data[col_index][i] = data_list[i][col_index].replace(',', '.')
-                    except ValueError:
-                        np_data[col_index][i] = -9999 # -9999 is used as ERROR value
-                    
-            col_index += 1
-
-        # Create the last np array containing region acronym
-        np_data.append(np.full(shape=(l), dtype="U64", fill_value=region))
+    def parse_regions(self, regions, chunk_rows=65536, archives=None):
+        """Parse data for several regions in a single pass over data archives. Each archive is opened once
+        and all requested region files are read from it. This method also downloads data archives which are missing.
 
-        return (self.col_headers, np_data)
+        Arguments:
+        regions -- list of region acronyms
+
+        Keyword arguments:
+        chunk_rows -- number of CSV rows converted at once, limits memory used by unconverted rows (default 65536)
+        archives -- list of archive names to read (default self.data_archives)
+
+        Returns:
+        Returns a dictionary mapping region acronyms to lists of ndarrays containing data.
+        """
+
+        parts = {region: list() for region in regions}
 
-    def get_list(self, regions=None):
+        for _, region, np_data in self.iter_region_chunks(regions, chunk_rows, archives):
+            parts[region].append(np_data)
+
+        return {region: self.aggregate(region_parts) for region, region_parts in parts.items()}
+
+    def iter_chunks(self, regions=None, chunk_rows=65536):
+        """Iterate over data of several regions in chunks of converted columns, without keeping more than one chunk
+        of CSV rows in memory. Data archives are read in a single pass, just like in parse_regions.
+
+        Keyword arguments:
+        regions -- list of region acronyms (default all regions)
+        chunk_rows -- maximum number of rows in a chunk (default 65536)
+
+        Yields:
+        Tuples of two elements. First being column headers (list), the second being a list of ndarrays
+        containing data of one chunk (including region column). Codes of category columns point into self.vocabulary.
+        """
+
+        if regions is None:
+            regions = self.region_files
+
+        for _, _, np_data in self.iter_region_chunks(regions, chunk_rows):
+            if len(np_data[0]): # Skip empty chunks
+                yield (self.col_headers, np_data)
+
+    def iter_region_chunks(self, regions, chunk_rows, archives=None):
+        """Iterate over data of several regions in chunks, used by parse_regions and iter_chunks.
+        At least one (possibly empty) chunk is produced for every region file.
+
+        Arguments:
+        regions -- list of region acronyms
+        chunk_rows -- maximum number of rows in a chunk
+
+        Keyword arguments:
+        archives -- list of archive names to read (default self.data_archives)
+
+        Yields:
+        Tuples of archive name, region acronym and list of ndarrays containing data of one chunk.
+        """
+
+        if archives is None:
+            archives = self.data_archives
+
+        self.check_archives(archives)
+
+        for archive in archives:
+            with ZipFile(f"./{self.folder}/{archive}", 'r') as zip_file:
+                for region in regions:
+                    metrics.count("parse.csv_bytes", zip_file.getinfo(self.region_files[region]).file_size)
+
+                    with zip_file.open(self.region_files[region], 'r') as data_file:
+                        csv_data = csv.reader(TextIOWrapper(data_file, "cp1250"), delimiter=';', quotechar='"')
+
+                        while True:
+                            # Reading includes decompression and decoding of the CSV file
+                            with metrics.timer("parse.csv"):
+                                rows = list(itertools.islice(csv_data, chunk_rows))
+                            with metrics.timer("parse.convert"):
+                                np_data = self.build_columns(rows)
+                            metrics.count("parse.rows", len(rows))
+
+                            # Create the last np array containing region code
+                            np_data.append(np.full(shape=(len(rows)), fill_value=self.vocabulary_index["region"][region], dtype=np.uint8))
+
+                            yield (archive, region, np_data)
+
+                            if len(rows) < chunk_rows: # End of file
+                                break
+
+    def build_columns(self, rows):
+        """Convert parsed CSV rows into typed np arrays, one whole column at a time.
+
+        Arguments:
+        rows -- list of CSV rows (lists of strings)
+
+        Returns:
+        Returns a list of ndarrays, one for each data type in self.data_types.
+        """
+
+        if rows:
+            columns = zip(*rows) # Transpose rows into columns
+        else:
+            columns = [()] * len(self.data_types)
+
+        return [self.convert_column(i, col) for i, col in enumerate(columns)]
+
+    def convert_column(self, index, col):
+        """Convert a column to its data type from self.data_types. Numbers which can not be parsed are set
+        to ERROR_VALUE, dates which can not be parsed are set to NaT.
+
+        Arguments:
+        index -- column index
+        col -- sequence of strings or ndarray (already converted columns are only narrowed)
+
+        Returns:
+        Returns a new ndarray.
+        """
+
+        t = self.data_types[index] if index < len(self.data_types) else "category"
+        is_number = isinstance(col, np.ndarray) and col.dtype.kind in "iuf"
+
+        if t.startswith("int"):
+            return narrow_ints(col if is_number else to_numeric(col, "int"), t)
+        elif t == "float64":
+            return col.astype(t) if is_number else to_numeric(col, "float")
+        elif t == "datetime64[D]":
+            return to_dates(col)
+        elif t == "category":
+            return self.encode(self.col_headers[index], np.array(col, dtype=str))
+        else: # String
+            return narrow_strings(np.array(col, dtype=str))
+
+    def encode(self, name, values):
+        """Encode values of a category column to codes into self.vocabulary[name]
+
+        Arguments:
+        name -- column name
+        values -- ndarray of strings
+
+        Returns:
+        Returns an ndarray of codes using the narrowest unsigned integer type.
+        """
+
+        vocab, codes = np.unique(values, return_inverse=True)
+        return self.recode(name, vocab, codes.reshape(-1))
+
+    def recode(self, name, vocab, codes):
+        """Translate codes into vocab to codes into self.vocabulary[name], new values are added to the vocabulary
+
+        Arguments:
+        name -- column name
+        vocab -- ndarray of values the codes point to
+        codes -- ndarray of codes
+
+        Returns:
+        Returns an ndarray of codes using the narrowest unsigned integer type. If no translation is needed,
+        codes themselves are returned (memory-mapped codes stay memory-mapped).
+        """
+
+        with self.lock:
+            words = self.vocabulary.setdefault(name, list())
+            index = self.vocabulary_index.setdefault(name, dict())
+
+            mapping = np.empty(shape=(len(vocab)), dtype=np.int64)
+            for i, word in enumerate(vocab.tolist()):
+                if word not in index:
+                    index[word] = len(words)
+                    words.append(word)
+                mapping[i] = index[word]
+
+            code_type = np.min_scalar_type(max(len(words) - 1, 0))
+
+        if np.array_equal(mapping, np.arange(len(vocab))):
+            return codes.astype(code_type, copy=False)
+
+        return mapping[codes].astype(code_type)
+
+    def decode(self, name, codes):
+        """Translate codes of a category column to its values
+
+        Arguments:
+        name -- column name
+        codes -- ndarray of codes
+
+        Returns:
+        Returns an ndarray of strings.
+        """
+
+        return narrow_strings(np.array(self.vocabulary[name], dtype=str))[codes]
+
+    def memory_usage(self, np_data):
+        """Compute memory used by each column, including vocabulary of category columns
+
+        Arguments:
+        np_data -- list of ndarrays containing data
+
+        Returns:
+        Returns a dictionary mapping column names to sizes in bytes.
+        """
+
+        usage = dict()
+
+        for header, col in zip(self.col_headers, np_data):
+            usage[header] = col.nbytes
+            if header in self.vocabulary:
+                usage[header] += narrow_strings(np.array(self.vocabulary[header], dtype=str)).nbytes
+
+        return usage
+
+    def load_cache(self, region, archive, columns=None):
+        """Load data of one region from one archive (a partition) from its cache directory. Columns are memory-mapped,
+        so only the parts of columns which are actually used are read from disk. Partitions of archives used by previous
+        versions are also created from old region caches if they exist.
+
+        Arguments:
+        region -- region acronym
+        archive -- archive name
+
+        Keyword arguments:
+        columns -- list of column names to load (default all columns)
+
+        Returns:
+        Returns a list of ndarrays containing partition data or None if the partition is not cached.
+        """
+
+        manifest = self.read_manifest(region, archive)
+
+        if manifest is None:
+            return None
+
+        return self.load_cache_dir(self.cache_path(region, archive), manifest, columns)
+
+    def read_manifest(self, region, archive):
+        """Read manifest of partition cache directory. Caches saved with different data types are converted first.
+
+        Arguments:
+        region -- region acronym
+        archive -- archive name
+
+        Returns:
+        Returns the manifest (dictionary) or None if the partition is not cached.
+        """
+
+        cache_dir_path = self.cache_path(region, archive)
+
+        if not os.path.isfile(f"{cache_dir_path}/manifest.json"):
+            if archive not in LEGACY_ARCHIVES or not self.split_legacy_cache(region):
+                return None
+
+        with open(f"{cache_dir_path}/manifest.json", "r") as manifest_file:
+            manifest = json.load(manifest_file)
+
+        if manifest.get("version") != CACHE_VERSION: # Cache was saved with different data types, convert it
+            np_data = [self.convert_column(i, col) for i, col in enumerate(self.load_cache_dir(cache_dir_path, manifest, decode=True))]
+            self.save_cache(region, archive, np_data)
+
+            with open(f"{cache_dir_path}/manifest.json", "r") as manifest_file:
+                manifest = json.load(manifest_file)
+
+        return manifest
+
+    @metrics.timed("cache.read")
+    def load_cache_dir(self, cache_dir_path, manifest=None, columns=None, decode=False):
+        """Load columns from a cache directory
+
+        Arguments:
+        cache_dir_path -- path of the cache directory
+
+        Keyword arguments:
+        manifest -- manifest of the cache directory, it is read if not given (default None)
+        columns -- list of column names to load (default all columns)
+        decode -- if True, category columns contain values instead of codes, used to convert old caches (default False)
+
+        Returns:
+        Returns a list of ndarrays (codes of category columns point into self.vocabulary), in order of columns if given.
+        """
+
+        if manifest is None:
+            with open(f"{cache_dir_path}/manifest.json", "r") as manifest_file:
+                manifest = json.load(manifest_file)
+
+        print(f"Loading data from cache directory: {cache_dir_path[7:]}", file=sys.stderr)
+        np_data = dict()
+
+        for col in manifest["columns"]:
+            if columns is not None and col["name"] not in columns:
+                continue
+
+            np_col = np.load(f"{cache_dir_path}/{col['file']}", mmap_mode="r")
+            metrics.count("cache.bytes_mapped", np_col.nbytes)
+
+            if "vocab" in col and decode:
+                np_col = np.load(f"{cache_dir_path}/{col['vocab']}")[np_col]
+            elif "vocab" in col: # Category column, translate codes to codes of this instance
+                np_col = self.recode(col["name"], np.load(f"{cache_dir_path}/{col['vocab']}"), np_col)
+
+            np_data[col["name"]] = np_col
+
+        return [np_data[name] for name in (columns if columns is not None else np_data)]
+
+    def split_legacy_cache(self, region):
+        """Create partitions of archives used by previous versions from old region cache (a cache directory without
+        partitions or a pickle file). Rows are assigned to archives by year of crash. Rows from years before
+        or after the years of archives go to the first or the last archive and rows without date go to the last
+        archive, so no rows are lost.
+
+        Arguments:
+        region -- region acronym
+
+        Returns:
+        Returns True if old region cache exists and partitions were created.
+        """
+
+        cache_dir_path = f"./{self.folder}/{self.cache_dirname.format(region)}"
+        cache_file_path = f"./{self.folder}/{self.cache_filename.format(region)}"
+
+        if os.path.isfile(f"{cache_dir_path}/manifest.json"):
+            np_data = self.load_cache_dir(cache_dir_path, decode=True)
+        elif os.path.isfile(cache_file_path):
+            with gzip.open(cache_file_path, "rb") as gfile:
+                print(f"Loading {region} region data from cache file: {cache_file_path[7:]}", file=sys.stderr)
+                np_data = pickle.load(gfile)
+        else:
+            return False
+
+        np_data = [self.convert_column(i, col) for i, col in enumerate(np_data)]
+        years = np_data[3].astype("datetime64[Y]").astype(np.int64) + 1970
+        archive_years = np.array([archive_year(archive) for archive in LEGACY_ARCHIVES])
+
+        # Index of archive of every row, archive years are sorted
+        archive_index = np.clip(np.searchsorted(archive_years, years), 0, len(LEGACY_ARCHIVES) - 1)
+        archive_index[np.isnat(np_data[3])] = len(LEGACY_ARCHIVES) - 1
+
+        for i, archive in enumerate(LEGACY_ARCHIVES):
+            mask = archive_index == i
+            self.save_cache(region, archive, [col[mask] for col in np_data])
+
+        return True
+
+    def cache_path(self, region, archive):
+        """Path of the cache directory of one region from one archive"""
+
+        return f"./{self.folder}/{self.cache_dirname.format(region)}/{os.path.splitext(archive)[0]}"
+
+    def cache_version(self, cache_dir_path):
+        """Version of a cache directory, None if the directory does not contain a manifest"""
+
+        try:
+            with open(f"{cache_dir_path}/manifest.json", "r") as manifest_file:
+                return json.load(manifest_file).get("version")
+        except (OSError, ValueError): # Missing or damaged manifest
+            return None
+
+    @contextlib.contextmanager
+    def lock_regions(self, regions):
+        """Lock regions, so that only one thread using this instance creates missing partitions of a region at a time
+        and other threads wait for them instead of parsing them again. Locks are acquired in sorted order to avoid deadlocks.
+
+        Arguments:
+        regions -- iterable of region acronyms
+        """
+
+        with self.lock:
+            locks = [self.region_locks.setdefault(region, threading.Lock()) for region in sorted(set(regions))]
+
+        with contextlib.ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            yield
+
+    @metrics.timed("cache.write")
+    def save_cache(self, region, archive, np_data):
+        """Save data of one region from one archive to its cache directory, each column is stored in its own .npy file.
+        The directory is written under a temporary name and then renamed, so concurrent writers never leave
+        a partially written cache. Existing cache directory of the current version is kept, so it is never
+        removed while other threads or processes read it.
+
+        Arguments:
+        region -- region acronym
+        archive -- archive name
+        np_data -- list of ndarrays containing partition data
+        """
+
+        cache_dir_path = self.cache_path(region, archive)
+        os.makedirs(os.path.dirname(cache_dir_path), exist_ok=True)
+
+        print(f"Adding {region} region data from {archive} to cache directory: {cache_dir_path[7:]}", file=sys.stderr)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(cache_dir_path), prefix=".tmp_")
+        try:
+            manifest = {"version": CACHE_VERSION, "rows": len(np_data[0]), "columns": list()}
+
+            for i, (header, col) in enumerate(zip(self.col_headers, np_data)):
+                np.save(f"{tmp_path}/{i:02d}.npy", col)
+                metrics.count("cache.bytes_written", col.nbytes)
+                manifest["columns"].append({"name": header, "file": f"{i:02d}.npy", "dtype": col.dtype.str, **self.column_stats(header, col)})
+
+                if header in self.vocabulary: # Category column, codes are useless without vocabulary
+                    np.save(f"{tmp_path}/{i:02d}.vocab.npy", narrow_strings(np.array(self.vocabulary[header], dtype=str)))
+                    manifest["columns"][-1]["vocab"] = f"{i:02d}.vocab.npy"
+
+            with open(f"{tmp_path}/manifest.json", "w") as manifest_file:
+                json.dump(manifest, manifest_file)
+
+            if self.cache_version(cache_dir_path) == CACHE_VERSION:
+                # Another thread or process has already written the same data, which may be being read right now
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+
+            if os.path.isdir(cache_dir_path): # Replace cache directory saved with different data types
+                shutil.rmtree(cache_dir_path, ignore_errors=True)
+            os.replace(tmp_path, cache_dir_path)
+        except OSError:
+            # Another process has already written the same data
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(cache_dir_path):
+                raise
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    def column_stats(self, header, col):
+        """Statistics of a column saved in manifest, used to skip partitions in select
+
+        Arguments:
+        header -- column name
+        col -- ndarray containing the column
+
+        Returns:
+        Returns a dictionary with present values of category columns (if there are not too many of them)
+        or minimum and maximum of numeric and date columns, missing values are ignored.
+        """
+
+        if len(col) == 0:
+            return dict()
+
+        if header in self.vocabulary:
+            codes = np.unique(col)
+            return {"values": [self.vocabulary[header][code] for code in codes]} if len(codes) <= 1024 else dict()
+
+        if col.dtype.kind == "M":
+            col = col[~np.isnat(col)]
+            return {"min": str(col.min()), "max": str(col.max())} if len(col) else dict()
+
+        if col.dtype.kind in "iu":
+            return {"min": int(col.min()), "max": int(col.max())}
+
+        if col.dtype.kind == "f":
+            col = col[~np.isnan(col)]
+            return {"min": float(col.min()), "max": float(col.max())} if len(col) else dict()
+
+        return dict()
+
+    @metrics.timed("get_list")
+    def get_list(self, regions=None, workers=None, update=False):
         """This method aggregates data of several regions.
 
+        Data of every region from every archive (a partition) is cached separately, so only partitions of new
+        archives have to be parsed when archives change.
+
         Keyword arguments:
         regions -- list of region acronyms
+        workers -- number of processes used to parse partitions which are not cached, None or 1 parses them serially (default None)
+        update -- if True, data archives are found on the index page first, see update_archives (default False)
 
         Returns:
         Returns a tuple of two elements. First being column headers (list), 
-        the second being a list of ndarrays containing aggregated data. 
+        the second being a list of ndarrays containing aggregated data. Arrays are read-only and shared
+        between calls with the same regions.
         """
 
-        np_data = list()
+        if update:
+            self.update_archives()
 
         if regions is None:
             regions = self.region_files
 
-        # Start caching or process data
+        regions = tuple(dict.fromkeys(regions)) # Remove duplicates, keep order
+
+        np_data = self.region_cache.get(regions)
+        if np_data is not None: # Same regions were already aggregated
+            metrics.count("cache.list_hits")
+            return (self.col_headers, np_data)
+
+        metrics.count("cache.list_misses")
+
+        loaded = dict() # Region -> partitions, keeps them alive even if they are evicted from cache meanwhile
         for region in regions:
-            cache_file_path = f"./{self.folder}/{self.cache_filename.format(region)}"
-
-            if region in self.region_cache.keys(): # Result is in memory
-                pass
-            elif os.path.isfile(cache_file_path): # Result is NOT in memory, but IS in cache file
-                with gzip.open(cache_file_path, "rb") as gfile:
-                    print(f"Loading {region} region data from cache file: {cache_file_path[7:]}", file=sys.stderr)
-                    self.region_cache[region] = pickle.load(gfile)
-            else: # Result is NEITHER in memory NOR cache file
-                # add to memory
-                self.region_cache[region] = self.parse_region_data(region)[1]
-                # add to cache
-                print(f"Adding {region} region data to cache file: {cache_file_path[7:]}", file=sys.stderr)
-                with gzip.open(cache_file_path, "wb") as gfile:
-                    pickle.dump(self.region_cache[region], gfile)
-
-        # Concatenate region data
-        for i in range(65):
-            np_data.append(np.concatenate([x[i] for _, x in self.region_cache.items()]))
+            loaded[region] = self.region_cache.get(region)
+            if loaded[region] is not None: # Result is in memory
+                metrics.count("cache.region_hits")
+            else:
+                metrics.count("cache.region_misses")
+
+        not_loaded = [region for region in regions if loaded[region] is None]
+
+        # Load partitions from cache files, remember partitions which have to be parsed
+        with self.lock_regions(not_loaded):
+            partitions = dict()
+            missing = dict() # Archive -> regions
+            for region in not_loaded:
+                loaded[region] = self.region_cache.get(region)
+                if loaded[region] is not None: # Loaded by another thread meanwhile
+                    continue
+
+                partitions[region] = dict()
+                for archive in self.data_archives:
+                    cached = self.load_cache(region, archive)
+                    if cached is not None: # Result is NOT in memory, but IS in cache file
+                        metrics.count("cache.partition_hits")
+                        partitions[region][archive] = cached
+                    else: # Result is NEITHER in memory NOR cache file
+                        metrics.count("cache.partition_misses")
+                        missing.setdefault(archive, list()).append(region)
+
+            for (region, archive), np_data in self.parse_partitions(missing, workers).items():
+                partitions[region][archive] = np_data
+
+            for region, region_partitions in partitions.items():
+                loaded[region] = [region_partitions[archive] for archive in self.data_archives]
+                self.region_cache.put(region, loaded[region])
+
+        np_data = self.aggregate([part for region in regions for part in loaded[region]])
+        self.region_cache.put(regions, np_data)
 
         return (self.col_headers, np_data)
 
+    @metrics.timed("parse.partitions")
+    def parse_partitions(self, missing, workers=None):
+        """Parse partitions which are not cached and save them to cache directories
+
+        Arguments:
+        missing -- dictionary mapping archive names to lists of region acronyms
+
+        Keyword arguments:
+        workers -- number of processes parsing archives, None or 1 parses them serially (default None)
+
+        Returns:
+        Returns a dictionary mapping (region, archive) tuples to lists of ndarrays containing partition data.
+        """
+
+        partitions = dict()
+
+        if missing and workers is not None and workers > 1:
+            # Download archives first, so that workers do not download them concurrently
+            self.check_archives(list(missing))
+
+            # Every worker parses all missing regions of one archive in one pass over it
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                args = [(self.url, self.folder, self.cache_filename, self.cache_dirname, archive, archive_regions) for archive, archive_regions in missing.items()]
+                list(executor.map(_parse_and_cache, args))
+
+            # Workers use their own vocabularies, load their results from cache to translate category codes
+            for archive, archive_regions in missing.items():
+                for region in archive_regions:
+                    partitions[(region, archive)] = self.load_cache(region, archive)
+        else:
+            for archive, archive_regions in missing.items():
+                parsed = self.parse_regions(archive_regions, archives=[archive])
+                for region in archive_regions:
+                    partitions[(region, archive)] = parsed[region]
+                    self.save_cache(region, archive, parsed[region])
+
+        return partitions
+
+    @metrics.timed("select")
+    def select(self, columns=None, where=None, regions=None, workers=None):
+        """Select columns of rows matching conditions. Only requested columns (and columns used in conditions) are read
+        from cache directories and partitions which can not contain matching rows, according to statistics
+        in their manifests, are skipped without reading them.
+
+        Keyword arguments:
+        columns -- list of column names (default all columns)
+        where -- dictionary mapping column names to a value or a list of values, rows matching all conditions are selected.
+                 Values of category columns are strings, "year" matches year of crash (p2a) and its values must be
+                 integers (or strings of integers), values of date columns may be given as strings (default None)
+        regions -- list of region acronyms (default all regions)
+        workers -- number of processes parsing partitions which are not cached, see get_list (default None)
+
+        Returns:
+        Returns a tuple of two elements. First being column names (list), the second being a list of ndarrays containing selected data.
+        """
+
+        if columns is None:
+            columns = self.col_headers
+
+        columns = list(columns)
+        where = {name: list(values) if isinstance(values, (list, tuple, set, np.ndarray)) else [values] for name, values in (where or dict()).items()}
+
+        for name in columns + [name for name in where if name != "year"]:
+            if name not in self.col_headers:
+                raise ValueError(f"Unknown column '{name}'")
+
+        where = {name: self.where_values(name, values) for name, values in where.items()}
+
+        if regions is None:
+            regions = self.region_files
+        if "region" in where: # Regions are partitions, no need to read them
+            regions = [region for region in regions if region in where["region"]]
+        regions = list(dict.fromkeys(regions))
+
+        # Parse partitions which are not cached
+        with self.lock_regions(regions):
+            missing = dict()
+            for region in regions:
+                for archive in self.data_archives:
+                    if self.read_manifest(region, archive) is None:
+                        missing.setdefault(archive, list()).append(region)
+
+            self.parse_partitions(missing, workers)
+
+        needed = list(dict.fromkeys(columns + [("p2a" if name == "year" else name) for name in where]))
+        parts = list()
+        empty = None
+
+        for region in regions:
+            for archive in self.data_archives:
+                manifest = self.read_manifest(region, archive)
+                matches = self.may_match(manifest, where)
+
+                if not matches and empty is not None: # Skip partition without reading it
+                    metrics.count("select.partitions_skipped")
+                    continue
+
+                np_data = dict(zip(needed, self.load_cache_dir(self.cache_path(region, archive), manifest, needed)))
+
+                if empty is None: # Used for empty result, data types are the same in all partitions
+                    empty = [np_data[name][:0] for name in columns]
+
+                if not matches:
+                    metrics.count("select.partitions_skipped")
+                    continue
+
+                metrics.count("select.partitions_read")
+                mask = np.ones(shape=(manifest["rows"]), dtype=bool)
+                for name, values in where.items():
+                    mask &= self.match(name, np_data["p2a" if name == "year" else name], values)
+
+                parts.append([np_data[name][mask] for name in columns])
+
+        if not parts:
+            parts = [empty] if empty is not None else [[np.empty(shape=(0)) for _ in columns]]
+
+        return (columns, self.aggregate(parts))
+
+    def where_values(self, name, values):
+        """Convert values of condition to types of stored data, so that statistics and rows are compared
+        with the same values, e.g. year "2016" is 2016 and date "2016-01-01" is numpy datetime64
+
+        Arguments:
+        name -- column name or "year"
+        values -- list of values
+
+        Returns:
+        Returns a list of converted values.
+        """
+
+        if name == "year":
+            years = list()
+            for value in values:
+                try:
+                    year = int(value)
+                    valid = year == float(value)
+                except (TypeError, ValueError):
+                    valid = False
+
+                if not valid:
+                    raise ValueError(f"Year must be an integer, got {value!r}")
+                years.append(year)
+
+            return years
+
+        data_type = self.data_types[self.col_headers.index(name)] if name != "region" else "category"
+        if data_type.startswith("datetime64"):
+            try:
+                return list(np.array(values, dtype=data_type))
+            except (TypeError, ValueError):
+                raise ValueError(f"Values of column '{name}' must be dates, got {values!r}") from None
+
+        return values
+
+    def may_match(self, manifest, where):
+        """Decide from statistics in manifest whether partition can contain rows matching conditions
+
+        Arguments:
+        manifest -- manifest of partition cache directory
+        where -- dictionary mapping column names (or "year") to lists of values
+        """
+
+        if manifest["rows"] == 0:
+            return False
+
+        stats = {col["name"]: col for col in manifest["columns"]}
+
+        for name, values in where.items():
+            col = stats["p2a" if name == "year" else name]
+
+            if "values" in col: # Category column, values present in partition are known
+                if not set(values) & set(col["values"]):
+                    return False
+            elif "min" in col:
+                if name == "year":
+                    low, high, values = int(col["min"][:4]), int(col["max"][:4]), np.array(values, dtype=np.int64)
+                elif col["dtype"][1] == "M":
+                    low, high, values = np.datetime64(col["min"]), np.datetime64(col["max"]), np.array(values, dtype="datetime64[D]")
+                else:
+                    low, high, values = col["min"], col["max"], np.array(values, dtype=np.float64)
+
+                if not ((values >= low) & (values <= high)).any():
+                    return False
+
+        return True
+
+    def match(self, name, col, values):
+        """Find rows matching condition
+
+        Arguments:
+        name -- column name or "year"
+        col -- ndarray containing the column (p2a for year)
+        values -- list of matching values
+
+        Returns:
+        Returns a boolean ndarray.
+        """
+
+        if name == "year":
+            return np.isin(col.astype("datetime64[Y]").astype(np.int64) + 1970, values)
+
+        if name in self.vocabulary: # Category column, compare codes
+            index = self.vocabulary_index[name]
+            return np.isin(col, [index[value] for value in values if value in index])
+
+        if col.dtype.kind == "M":
+            return np.isin(col, np.array(values, dtype=col.dtype))
+
+        return np.isin(col, values)
+
+    @metrics.timed("aggregate")
+    def aggregate(self, parts):
+        """Concatenate data of several regions. Output arrays are allocated once using known row counts,
+        data of a single region is returned without copying.
+
+        Arguments:
+        parts -- list of lists of ndarrays containing region data
+
+        Returns:
+        Returns a list of read-only ndarrays containing aggregated data.
+        """
+
+        if len(parts) == 1:
+            np_data = list(parts[0])
+        else:
+            rows = [len(part[0]) for part in parts]
+            offsets = np.concatenate([[0], np.cumsum(rows)])
+            np_data = list()
+
+            for i in range(len(parts[0])):
+                np_col = np.empty(shape=(offsets[-1]), dtype=np.result_type(*[part[i] for part in parts]))
+
+                for part, start, end in zip(parts, offsets[:-1], offsets[1:]):
+                    np_col[start:end] = part[i]
+
+                np_data.append(np_col)
+
+        for np_col in np_data:
+            np_col.flags.writeable = False
+
+        return np_data
+
+
+def _parse_and_cache(args):
+    """Parse data of several regions from one archive and save it to cache files, used by worker processes of DataDownloader.get_list
+
+    Arguments:
+    args -- tuple of url, folder, cache filename and cache directory name of DataDownloader, archive name and list of region acronyms
+    """
+
+    url, folder, cache_filename, cache_dirname, archive, regions = args
+    downloader = DataDownloader(url, folder, cache_filename, cache_dirname)
+
+    parsed = downloader.parse_regions(regions, archives=[archive])
+    for region in regions:
+        downloader.save_cache(region, archive, parsed[region])
+
 if __name__ == "__main__":
-    data = DataDownloader().get_list(["MSK", "JHM", "ZLK"])
+    downloader = DataDownloader()
+    data = downloader.get_list(["MSK", "JHM", "ZLK"])
     print("Kraje: MSK, JHM, ZLK")
     print(f"Počet záznamů: {len(data[1][0])}")
     print(f"Sloupce: {data[0]}")
+    # 1 MB = 1048576 B
+    print(f"Velikost: {sum(downloader.memory_usage(data[1]).values()) / 1048576:.1f} MB")
@@ -5,15 +5,39 @@ This module plots maps visualising car crashes.
 
 __author__ = "Martin Kostelník (xkoste12)"
 
+import functools
+import hashlib
+import os
+import pickle
+import tempfile
+import pyproj
+import metrics
 import pandas as pd
 import geopandas
-import matplotlib.pyplot as plt
-import contextily as ctx
-import sklearn.cluster
 import numpy as np
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+from concurrent.futures import ProcessPoolExecutor
 
 
+def save_atomic(filename: str, save):
+    """Write file under unique temporary name in the same folder and rename it, so that the file is never
+    left partially written, even if more processes write it at once
+
+    Keyword arguments:
+    filename -- path of the written file
+    save -- function writing content of the file to a binary file object
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            save(f)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@metrics.timed("geo.make_geo")
 def make_geo(df: pd.DataFrame) -> geopandas.GeoDataFrame:
     """Create geodataframe from existing dataframe using correct encoding
 
@@ -27,7 +51,331 @@ def make_geo(df: pd.DataFrame) -> geopandas.GeoDataFrame:
     return geopandas.GeoDataFrame(df, geometry=geopandas.points_from_xy(df['d'], df['e']), crs="EPSG:5514")
 
 
-def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False):
+class GridIndex:
+    """Spatial index over crash coordinates. Points are sorted by cells of a regular grid (row by row),
+    so a query only touches points in cells overlapping the queried area. Results are positions
+    of rows in the indexed dataframe (usable with iloc).
+    """
+
+    def __init__(self, x: np.ndarray, y: np.ndarray, cell_size: float = 1000.0):
+        """Build index over points
+
+        Keyword arguments:
+        x -- x coordinates of points in S-JTSK (column d), points with NaN coordinates are not indexed
+        y -- y coordinates of points in S-JTSK (column e)
+        cell_size -- size of grid cell in meters (default 1000)
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        rows = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+
+        self.cell_size = float(cell_size)
+        self.fingerprint = None
+
+        if len(rows):
+            self.x0, self.y0 = x[rows].min(), y[rows].min()
+            self.nx = int((x[rows].max() - self.x0) // self.cell_size) + 1
+            self.ny = int((y[rows].max() - self.y0) // self.cell_size) + 1
+        else:
+            self.x0, self.y0, self.nx, self.ny = 0.0, 0.0, 1, 1
+
+        cells = (((y[rows] - self.y0) // self.cell_size).astype(np.int64) * self.nx
+                 + ((x[rows] - self.x0) // self.cell_size).astype(np.int64))
+        order = np.argsort(cells, kind="stable")
+
+        self.rows = rows[order]
+        self.x = x[self.rows]
+        self.y = y[self.rows]
+        # Points of cell i are at positions starts[i]:starts[i + 1]
+        self.starts = np.searchsorted(cells[order], np.arange(self.nx * self.ny + 1))
+
+    def _candidates(self, xmin: float, ymin: float, xmax: float, ymax: float) -> np.ndarray:
+        """Positions (in sorted points) of all points in cells overlapping the box"""
+        cx0 = max(int((xmin - self.x0) // self.cell_size), 0)
+        cx1 = min(int((xmax - self.x0) // self.cell_size), self.nx - 1)
+        cy0 = max(int((ymin - self.y0) // self.cell_size), 0)
+        cy1 = min(int((ymax - self.y0) // self.cell_size), self.ny - 1)
+
+        if cx0 > cx1 or cy0 > cy1: # Box is outside the grid
+            return np.array([], dtype=np.int64)
+
+        # Cells of one grid row are stored next to each other
+        return np.concatenate([np.arange(self.starts[cy * self.nx + cx0], self.starts[cy * self.nx + cx1 + 1]) for cy in range(cy0, cy1 + 1)])
+
+    def bbox(self, xmin: float, ymin: float, xmax: float, ymax: float) -> np.ndarray:
+        """Find points inside bounding box (borders included)
+
+        Returns:
+        Sorted positions of rows
+        """
+        pos = self._candidates(xmin, ymin, xmax, ymax)
+        x, y = self.x[pos], self.y[pos]
+
+        return np.sort(self.rows[pos[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]])
+
+    def radius(self, x: float, y: float, r: float) -> np.ndarray:
+        """Find points not further than r meters from point (x, y)
+
+        Returns:
+        Sorted positions of rows
+        """
+        pos = self._candidates(x - r, y - r, x + r, y + r)
+
+        return np.sort(self.rows[pos[(self.x[pos] - x) ** 2 + (self.y[pos] - y) ** 2 <= r ** 2]])
+
+    def knn(self, x: float, y: float, k: int) -> np.ndarray:
+        """Find k points nearest to point (x, y)
+
+        Returns:
+        Positions of rows ordered by distance
+        """
+        r = self.cell_size
+        extent = self.cell_size * max(self.nx, self.ny)
+
+        # Grow the searched square until it contains k points which are closer than its half size
+        while True:
+            pos = self._candidates(x - r, y - r, x + r, y + r)
+            dist = (self.x[pos] - x) ** 2 + (self.y[pos] - y) ** 2
+
+            if (dist <= r ** 2).sum() >= k or (r > abs(x - self.x0) + extent and r > abs(y - self.y0) + extent):
+                break
+            r *= 2
+
+        return self.rows[pos[np.argsort(dist, kind="stable")[:k]]]
+
+    def save(self, filename: str):
+        """Save index to .npz file, the file is written under unique temporary name first"""
+        save_atomic(filename, lambda f: np.savez(f, rows=self.rows, x=self.x, y=self.y, starts=self.starts,
+                                                 grid=np.array([self.x0, self.y0, self.cell_size, self.nx, self.ny]),
+                                                 fingerprint=np.array(self.fingerprint or "")))
+
+    @classmethod
+    def load(cls, filename: str) -> "GridIndex":
+        """Load index saved by save"""
+        index = cls.__new__(cls)
+
+        with np.load(filename) as data:
+            index.rows, index.x, index.y, index.starts = data["rows"], data["x"], data["y"], data["starts"]
+            index.x0, index.y0, index.cell_size, nx, ny = data["grid"].tolist()
+            index.nx, index.ny = int(nx), int(ny)
+            index.fingerprint = str(data["fingerprint"]) or None
+
+        return index
+
+
+def coordinates(gdf: pd.DataFrame) -> tuple:
+    """Get S-JTSK coordinates of crashes (columns d and e) and their fingerprint, which identifies
+    data derived from coordinates in cache files
+
+    Returns:
+    Tuple of x coordinates, y coordinates and fingerprint (str)
+    """
+    x = gdf["d"].to_numpy(dtype=np.float64)
+    y = gdf["e"].to_numpy(dtype=np.float64)
+
+    return x, y, hashlib.sha1(x.tobytes() + y.tobytes()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(source: str, target: str) -> pyproj.Transformer:
+    """Get transformer between two CRS, transformers are reused because creating them is slow"""
+    return pyproj.Transformer.from_crs(source, target, always_xy=True)
+
+
+@metrics.timed("geo.project")
+def project(gdf: pd.DataFrame, filename: str = "accidents.3857.npz", batch_size: int = 1000000) -> tuple:
+    """Project crash coordinates of the whole dataframe from S-JTSK to Web Mercator (EPSG:3857).
+    Projected coordinates are cached in a file and computed again only when coordinates in the dataframe change.
+
+    Keyword arguments:
+    gdf -- dataframe containing car crashes data
+    filename -- name of the cache file, None disables caching (default accidents.3857.npz)
+    batch_size -- number of points projected at once, limits memory used by temporary arrays (default 1000000)
+
+    Returns:
+    Tuple of projected x and y coordinates (ndarrays), rows are in the same order as in the dataframe
+    """
+    x, y, fingerprint = coordinates(gdf)
+
+    if filename is not None and os.path.isfile(filename):
+        with np.load(filename) as data:
+            if str(data["fingerprint"]) == fingerprint:
+                metrics.count("geo.projection_cache_hits")
+                return data["x"], data["y"]
+
+    metrics.count("geo.projection_cache_misses")
+
+    transformer = get_transformer("EPSG:5514", "EPSG:3857")
+    px = np.empty_like(x)
+    py = np.empty_like(y)
+
+    for start in range(0, len(x), batch_size):
+        end = start + batch_size
+        px[start:end], py[start:end] = transformer.transform(x[start:end], y[start:end])
+
+    if filename is not None:
+        save_atomic(filename, lambda f: np.savez(f, x=px, y=py, fingerprint=np.array(fingerprint)))
+
+    return px, py
+
+
+def to_web_mercator(gdf: geopandas.GeoDataFrame, rows: np.ndarray = None, filename: str = "accidents.3857.npz") -> geopandas.GeoDataFrame:
+    """Create geodataframe in Web Mercator (EPSG:3857) from selected rows using projected coordinates from project,
+    which replaces calling to_crs on every plotted subset
+
+    Keyword arguments:
+    gdf -- existing geodataframe containing car crashes data
+    rows -- positions of selected rows (default all rows)
+    filename -- name of the cache file with projected coordinates (default accidents.3857.npz)
+    """
+    px, py = project(gdf, filename)
+
+    if rows is None:
+        rows = np.arange(len(gdf))
+
+    return geopandas.GeoDataFrame(gdf.iloc[rows].drop(columns=gdf.geometry.name),
+                                  geometry=geopandas.points_from_xy(px[rows], py[rows]), crs="EPSG:3857")
+
+
+@metrics.timed("geo.get_index")
+def get_index(gdf: pd.DataFrame, filename: str = "accidents.idx.npz", cell_size: float = 1000.0) -> GridIndex:
+    """Get spatial index over crash coordinates (columns d and e) of dataframe. The index is cached in a file
+    and rebuilt only when coordinates in the dataframe change.
+
+    Keyword arguments:
+    gdf -- dataframe containing car crashes data
+    filename -- name of the cache file, None disables caching (default accidents.idx.npz)
+    cell_size -- size of grid cell in meters (default 1000)
+    """
+    x, y, fingerprint = coordinates(gdf)
+
+    if filename is not None and os.path.isfile(filename):
+        index = GridIndex.load(filename)
+        if index.fingerprint == fingerprint and index.cell_size == cell_size:
+            metrics.count("geo.index_cache_hits")
+            return index
+
+    metrics.count("geo.index_cache_misses")
+
+    index = GridIndex(x, y, cell_size)
+    index.fingerprint = fingerprint
+
+    if filename is not None:
+        index.save(filename)
+
+    return index
+
+
+def select_area(gdf: geopandas.GeoDataFrame, bbox: tuple = None, index: GridIndex = None) -> np.ndarray:
+    """Select crashes in MSK or, if bbox is given, crashes inside the bounding box
+
+    Keyword arguments:
+    gdf -- existing geodataframe containing car crashes data
+    bbox -- (xmin, ymin, xmax, ymax) in S-JTSK (default None)
+    index -- spatial index of gdf, loaded by get_index if not given (default None)
+
+    Returns:
+    Sorted positions of selected rows
+    """
+    if bbox is None:
+        return np.flatnonzero((gdf.region == "MSK").to_numpy())
+
+    if index is None:
+        index = get_index(gdf)
+
+    return index.bbox(*bbox)
+
+
+def crashes_near(gdf: geopandas.GeoDataFrame, x: float, y: float, radius: float = None, k: int = None, index: GridIndex = None) -> geopandas.GeoDataFrame:
+    """Find crashes near point, either all crashes in radius or k nearest crashes
+
+    Keyword arguments:
+    gdf -- existing geodataframe containing car crashes data
+    x -- x coordinate of the point in S-JTSK
+    y -- y coordinate of the point in S-JTSK
+    radius -- distance in meters (default None)
+    k -- number of crashes, used if radius is not given (default None)
+    index -- spatial index of gdf, loaded by get_index if not given (default None)
+    """
+    if index is None:
+        index = get_index(gdf)
+
+    if radius is not None:
+        return gdf.iloc[index.radius(x, y, radius)]
+
+    return gdf.iloc[index.knn(x, y, k if k is not None else 10)]
+
+
+def data_extent(gdf: geopandas.GeoDataFrame, margin: float = 0.05) -> tuple:
+    """Extent (xmin, xmax, ymin, ymax) of points with margin added on every side, just like matplotlib autoscaling does
+
+    Keyword arguments:
+    gdf -- geodataframe containing points
+    margin -- margin as a fraction of width and height (default 0.05)
+    """
+    if len(gdf) == 0:
+        return (0.0, 1.0, 0.0, 1.0)
+
+    xmin, ymin, xmax, ymax = gdf.total_bounds
+    dx, dy = (xmax - xmin) * margin, (ymax - ymin) * margin
+
+    return (xmin - dx, xmax + dx, ymin - dy, ymax + dy)
+
+
+def plot_density(ax, x: np.ndarray, y: np.ndarray, extent: tuple, bins: int = 512, cmap: str = "viridis", alpha: float = 0.7):
+    """Plot density of points as a single image layer, so drawing and file size do not depend on number of points
+
+    Keyword arguments:
+    ax -- matplotlib axes
+    x -- x coordinates of points
+    y -- y coordinates of points
+    extent -- extent of the image (xmin, xmax, ymin, ymax)
+    bins -- number of bins along the longer side of extent (default 512)
+    cmap -- colormap (default viridis)
+    alpha -- opacity of the image (default 0.7)
+
+    Returns:
+    Image drawn into axes, None if there are no points in extent
+    """
+    import matplotlib.colors
+
+    xmin, xmax, ymin, ymax = extent
+    ax.set(xlim=(xmin, xmax), ylim=(ymin, ymax))
+
+    # Square bins
+    scale = bins / max(xmax - xmin, ymax - ymin)
+    nx, ny = max(int(round((xmax - xmin) * scale)), 1), max(int(round((ymax - ymin) * scale)), 1)
+
+    hist, _, _ = np.histogram2d(y, x, bins=[ny, nx], range=[[ymin, ymax], [xmin, xmax]])
+    if not hist.any():
+        return None
+
+    # Bins without crashes are transparent, counts are on logarithmic scale
+    return ax.imshow(np.ma.masked_equal(hist, 0), extent=extent, origin="lower", cmap=cmap, norm=matplotlib.colors.LogNorm(),
+                     alpha=alpha, interpolation="nearest", zorder=1)
+
+
+def plot_crashes(ax, gdf: geopandas.GeoDataFrame, render: str = "points", extent: tuple = None, markersize: float = 0.5):
+    """Plot crashes as points or as density image
+
+    Keyword arguments:
+    ax -- matplotlib axes
+    gdf -- geodataframe containing crashes
+    render -- "points" draws a marker for every crash, "density" draws a 2D histogram (default points)
+    extent -- extent of density image (default extent of gdf)
+    markersize -- size of markers of points (default 0.5)
+    """
+    if render == "points":
+        gdf.plot(ax=ax, markersize=markersize, alpha=0.3)
+    elif render == "density":
+        plot_density(ax, gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy(), extent if extent is not None else data_extent(gdf))
+    else:
+        raise ValueError(f"Unknown render mode '{render}'")
+
+
+@metrics.timed("geo.plot_geo")
+def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False, bbox: tuple = None, index: GridIndex = None,
+             render: str = "points", offline: bool = None):
     """Plot two charts displaying car crashes in MSK. First chart displays crashes inside cities,
     while the second one displays crashes outsides cities.
 
@@ -35,20 +383,29 @@ def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure:
     gdf -- existing geodataframe containing car crashes data
     fig_location -- plots will be saved to this file (default None)
     show_figure -- if True, function displays the plots on screen (default False)
+    bbox -- plot crashes inside (xmin, ymin, xmax, ymax) in S-JTSK instead of MSK (default None)
+    index -- spatial index of gdf used with bbox (default None)
+    render -- "points" or "density", see plot_crashes (default points)
+    offline -- if True, basemap is drawn only from cached tiles, see tiles.add_basemap (default IZV_OFFLINE environment variable)
     """
-    gdf = gdf[gdf.region == "MSK"].copy().to_crs(crs="EPSG:3857")
+    import matplotlib.pyplot as plt # Plotting and clustering libraries are imported only when they are used
+    import tiles
+
+    gdf = to_web_mercator(gdf, select_area(gdf, bbox, index))
+    area = "v MSK" if bbox is None else "ve vybrané oblasti"
+    extent = data_extent(gdf) # Both charts show the same area
 
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 6))
 
-    gdf[gdf.p5a == 1].plot(ax=ax1, markersize=0.7, alpha=0.3)
-    gdf[gdf.p5a == 2].plot(ax=ax2, markersize=0.7, alpha=0.3)
+    plot_crashes(ax1, gdf[gdf.p5a == 1], render, extent, markersize=0.7)
+    plot_crashes(ax2, gdf[gdf.p5a == 2], render, extent, markersize=0.7)
     
-    ctx.add_basemap(ax1, crs=gdf.crs.to_string(), source=ctx.providers.Stamen.TonerLite, attribution_size=5)
-    ax1.set(title="Nehody v MSK v obci", xlim=ax2.get_xlim(), ylim=ax2.get_ylim())
+    tiles.add_basemap(ax1, offline=offline, attribution_size=5)
+    ax1.set(title=f"Nehody {area} v obci", xlim=ax2.get_xlim(), ylim=ax2.get_ylim())
     ax1.axis("off")
 
-    ctx.add_basemap(ax2, crs=gdf.crs.to_string(), source=ctx.providers.Stamen.TonerLite, attribution_size=5)
-    ax2.set(title="Nehody v MSK mimo obec")
+    tiles.add_basemap(ax2, offline=offline, attribution_size=5)
+    ax2.set(title=f"Nehody {area} mimo obec")
     ax2.axis("off")
 
     fig.tight_layout()
@@ -60,25 +417,162 @@ def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure:
         plt.savefig(fig_location)
 
 
-def plot_cluster(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False):
+def cluster_points(x: np.ndarray, y: np.ndarray, method: str = "kmeans", n_clusters: int = 24, cell_size: float = 1000.0, min_count: int = 50) -> tuple:
+    """Find clusters of points
+
+    Keyword arguments:
+    x -- x coordinates of points
+    y -- y coordinates of points
+    method -- "kmeans" (MiniBatchKMeans with n_clusters clusters) or "grid" (hotspots, that is connected
+              grid cells containing at least min_count points each, points outside hotspots are not clustered) (default kmeans)
+    n_clusters -- number of clusters found by kmeans (default 24)
+    cell_size -- size of grid cell in units of coordinates, used by grid (default 1000)
+    min_count -- minimal number of points in a hotspot cell, used by grid (default 50)
+
+    Returns:
+    Tuple of labels of points (-1 for points outside clusters), cluster centres (n x 2) and numbers of points in clusters
+    """
+    if method == "kmeans":
+        n_clusters = min(n_clusters, len(x))
+        if n_clusters == 0:
+            return np.array([], dtype=np.int64), np.zeros((0, 2)), np.array([], dtype=np.int64)
+
+        import sklearn.cluster
+
+        model = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, random_state=0).fit(np.column_stack([x, y]))
+        labels = model.labels_.astype(np.int64)
+
+        return labels, model.cluster_centers_, np.bincount(labels, minlength=n_clusters)
+
+    if method != "grid":
+        raise ValueError(f"Unknown clustering method '{method}'")
+
+    if len(x) == 0:
+        return np.array([], dtype=np.int64), np.zeros((0, 2)), np.array([], dtype=np.int64)
+
+    cx = ((x - x.min()) // cell_size).astype(np.int64)
+    cy = ((y - y.min()) // cell_size).astype(np.int64)
+    nx, ny = cx.max() + 1, cy.max() + 1
+
+    # Density of points in grid cells, neighbouring dense cells (including diagonal ones) form one hotspot
+    import scipy.ndimage
+
+    density = np.bincount(cy * nx + cx, minlength=nx * ny).reshape(ny, nx)
+    cell_labels, n_clusters = scipy.ndimage.label(density >= min_count, structure=np.ones((3, 3)))
+    labels = cell_labels[cy, cx].astype(np.int64) - 1
+
+    clustered = labels >= 0
+    counts = np.bincount(labels[clustered], minlength=n_clusters)
+    centres = np.column_stack([
+        np.bincount(labels[clustered], weights=x[clustered], minlength=n_clusters) / counts,
+        np.bincount(labels[clustered], weights=y[clustered], minlength=n_clusters) / counts,
+    ])
+
+    return labels, centres, counts
+
+
+def _cluster_region(args: tuple) -> tuple:
+    """Find clusters of one region, used by worker processes of get_clusters
+
+    Keyword arguments:
+    args -- tuple of x coordinates, y coordinates and keyword arguments of cluster_points
+
+    Returns:
+    Tuple of cluster centres and numbers of points in clusters
+    """
+    x, y, params = args
+    _, centres, counts = cluster_points(x, y, **params)
+
+    return centres, counts
+
+
+@metrics.timed("geo.get_clusters")
+def get_clusters(gdf: geopandas.GeoDataFrame, regions: list = None, method: str = "kmeans", n_clusters: int = 24, cell_size: float = 1000.0,
+                 min_count: int = 50, workers: int = None, filename: str = "accidents.clusters.pkl") -> dict:
+    """Find clusters of crashes in Web Mercator coordinates, every region is clustered separately. Cluster centres
+    and counts are cached in a file, so only regions which were not clustered with the same parameters are clustered.
+
+    Keyword arguments:
+    gdf -- existing geodataframe containing car crashes data
+    regions -- list of region acronyms, None clusters crashes of the whole country together (default None)
+    method, n_clusters, cell_size, min_count -- parameters of cluster_points
+    workers -- number of processes clustering regions, None or 1 clusters them serially (default None)
+    filename -- name of the cache file, None disables caching (default accidents.clusters.pkl)
+
+    Returns:
+    Dictionary mapping region acronyms (None for the whole country) to tuples of cluster centres and numbers of points in clusters
+    """
+    params = {"method": method, "n_clusters": n_clusters, "cell_size": cell_size, "min_count": min_count}
+    if regions is None:
+        regions = [None]
+
+    _, _, fingerprint = coordinates(gdf)
+    cache = {"fingerprint": fingerprint, "clusters": dict()}
+
+    if filename is not None and os.path.isfile(filename):
+        with open(filename, "rb") as f:
+            cached = pickle.load(f)
+        if cached["fingerprint"] == fingerprint: # Clusters of other data are useless
+            cache = cached
+
+    key = tuple(sorted(params.items()))
+    missing = [region for region in regions if (key, region) not in cache["clusters"]]
+    metrics.count("geo.cluster_cache_hits", len(regions) - len(missing))
+    metrics.count("geo.cluster_cache_misses", len(missing))
+
+    if missing:
+        px, py = project(gdf)
+        region_col = gdf["region"].to_numpy()
+        args = list()
+
+        for region in missing:
+            rows = np.flatnonzero(region_col == region) if region is not None else np.arange(len(gdf))
+            args.append((px[rows], py[rows], params))
+
+        if workers is not None and workers > 1 and len(missing) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_cluster_region, args))
+        else:
+            results = [_cluster_region(arg) for arg in args]
+
+        for region, result in zip(missing, results):
+            cache["clusters"][(key, region)] = result
+
+        if filename is not None:
+            save_atomic(filename, lambda f: pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    return {region: cache["clusters"][(key, region)] for region in regions}
+
+
+@metrics.timed("geo.plot_cluster")
+def plot_cluster(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False, bbox: tuple = None, index: GridIndex = None,
+                 method: str = "kmeans", render: str = "points", offline: bool = None):
     """Plot car crashes in clusters
     
     Keyword arguments:
     gdf -- existing geodataframe containing car crashes data
     fig_location -- plots will be saved to this file (default None)
     show_figure -- if True, function displays the plots on screen (default False)
+    bbox -- plot crashes inside (xmin, ymin, xmax, ymax) in S-JTSK instead of MSK (default None)
+    index -- spatial index of gdf used with bbox (default None)
+    method -- clustering method, see cluster_points (default kmeans)
+    render -- "points" or "density", see plot_crashes (default points)
+    offline -- if True, basemap is drawn only from cached tiles, see tiles.add_basemap (default IZV_OFFLINE environment variable)
     """
-    gdf = gdf[gdf.region == "MSK"].copy().to_crs(crs="EPSG:3857")
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
+    import tiles
 
-    N_CLUSTERS = 24
-    coords = np.dstack([gdf.geometry.x, gdf.geometry.y]).reshape(-1, 2)
-    model = sklearn.cluster.MiniBatchKMeans(n_clusters=N_CLUSTERS).fit(coords)
+    if bbox is None: # Clusters of MSK are cached
+        centres, counts = get_clusters(gdf, ["MSK"], method)["MSK"]
+        gdf = to_web_mercator(gdf, select_area(gdf))
+        area = "v MSK"
+    else:
+        gdf = to_web_mercator(gdf, select_area(gdf, bbox, index))
+        _, centres, counts = cluster_points(gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy(), method)
+        area = "ve vybrané oblasti"
 
-    gdf_c = gdf.copy()
-    gdf_c["cluster"] = model.labels_
-    gdf_c = gdf_c.dissolve(by="cluster", aggfunc={"p1": "count"}).rename(columns={"p1": "cnt"})
-    gdf_c_coords = geopandas.GeoDataFrame(geometry=geopandas.points_from_xy(model.cluster_centers_[:, 0], model.cluster_centers_[:, 1]))
-    gdf_c = gdf_c.merge(gdf_c_coords, left_on="cluster", right_index=True).set_geometry("geometry_y")
+    gdf_c = geopandas.GeoDataFrame({"cnt": counts}, geometry=geopandas.points_from_xy(centres[:, 0], centres[:, 1]), crs=gdf.crs)
 
     plt.figure(figsize=(12, 10))
     ax = plt.gca()
@@ -86,11 +580,11 @@ def plot_cluster(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_fig
     # Manipulate the colorbar
     cax = make_axes_locatable(ax).append_axes("right", size="5%", pad=0.1)
 
-    gdf.plot(ax=ax, markersize=0.5, alpha=0.3) # Plot all crashes
+    plot_crashes(ax, gdf, render) # Plot all crashes
     gdf_c.plot(ax=ax, cax=cax, markersize=gdf_c["cnt"] * 1.5, column="cnt", legend=True, legend_kwds={"label": "Počet nehod"}, alpha=0.5) # Plot clusters
 
-    ctx.add_basemap(ax, crs=gdf.crs.to_string(), source=ctx.providers.Stamen.TonerLite, attribution_size=10)
-    ax.set(title="Nehody v MSK")
+    tiles.add_basemap(ax, offline=offline, attribution_size=10)
+    ax.set(title=f"Nehody {area}")
     ax.axis("off")
 
     plt.tight_layout()
@@ -8,7 +8,6 @@ __author__ = "Martin Kostelník (xkoste12)"
 import argparse
 import os
 import sys
-import matplotlib.pyplot as plt
 import numpy as np
 import download as dl
 
@@ -22,6 +21,42 @@ def parse_arguments():
 
     return parser.parse_args()
 
+def count_crashes(data_source):
+    """Count crashes per year and region in one pass over date and region columns
+
+    Arguments:
+    data_source -- parsed data from DataDownloader.get_list
+
+    Returns:
+    Returns a tuple of three elements. First being an ndarray of years, the second being an ndarray
+    of region acronyms (sorted) and the third being a matrix of crash counts (years x regions).
+    """
+
+    dates = data_source[1][3]
+    region_codes = data_source[1][-1].astype(np.int64)
+    region_names = np.array(dl.DataDownloader().vocabulary["region"])
+
+    valid = ~np.isnat(dates)
+    years = dates[valid].astype("datetime64[Y]").astype(np.int64) + 1970
+    region_codes = region_codes[valid]
+
+    if len(years) == 0:
+        return (np.array([], dtype=np.int64), np.array([], dtype=str), np.zeros((0, 0), dtype=np.int64))
+
+    first_year = years.min()
+    n_years = years.max() - first_year + 1
+    n_regions = len(region_names)
+
+    counts = np.bincount((years - first_year) * n_regions + region_codes, minlength=n_years * n_regions).reshape(n_years, n_regions)
+
+    # Keep only years and regions which are present in the data, regions are sorted by name
+    year_mask = counts.sum(axis=1) > 0
+    region_order = np.argsort(region_names)
+    region_order = region_order[counts[:, region_order].sum(axis=0) > 0]
+
+    return (np.arange(first_year, first_year + n_years)[year_mask], region_names[region_order], counts[year_mask][:, region_order])
+
+
 def plot_stat(data_source, fig_location = None, show_figure = False):
     """Plot parse data into nice charts
 
@@ -32,44 +67,48 @@ def plot_stat(data_source, fig_location = None, show_figure = False):
     fig_location -- Save plotted charts into this folder. Name of the file is always 'crashes.pdf' (default None)
     show_figure -- Display plotted charts. (default None)
     """
+    import matplotlib.pyplot as plt # Counting crashes does not need matplotlib
 
-    fig, axs = plt.subplots(5, figsize=(10, 20))
+    months = ["leden", "únor", "březen", "duben", "květen", "červen", "červenec", "srpen", "září", "říjen", "listopad", "prosinec"]
 
-    data = {"2016": list(),
-            "2017": list(),
-            "2018": list(),
-            "2019": list(),
-            "2020": list(),}
+    years, regions, counts = count_crashes(data_source)
 
-    # Group data by year
-    i = 0
-    for d in data_source[1][3]:
-        data[d[:4]].append(data_source[1][-1][i])
-        i += 1
+    # Last month with data, used to mark years which are not complete
+    dates = data_source[1][3]
+    last_month = int(str(dates[~np.isnat(dates)].max().astype("datetime64[M]"))[5:7]) if len(years) else 12
 
-    # Plot a bar chart for each year
-    i = 0
-    for key in data:
-        unique, counts = np.unique(np.array(data[key], dtype="U4"), return_counts=True)
+    fig, axs = plt.subplots(max(len(years), 1), figsize=(10, 4 * max(len(years), 1)), squeeze=False)
+    axs = axs[:, 0]
 
-        # Sort data by accident count
-        s_counts = counts.copy()
-        s_counts[::-1].sort()
+    if len(years) == 0: # No crashes with valid dates, the figure only contains a message
+        axs[0].text(0.5, 0.5, "Žádná data o dopravních nehodách", ha="center", va="center", transform=axs[0].transAxes)
+        axs[0].set_axis_off()
 
-        axs[i].title.set_text(f"Počet dopravních nehod v roce {key} (leden - září)" if key == "2020" else f"Počet dopravních nehod v roce {key}")
-        axs[i].bar(unique, counts)
+    # Leave space for order labels above the highest bar
+    ylim = max(25000, int(np.ceil((counts.max() + 1000) / 5000)) * 5000) if counts.size else 25000
 
-        axs[i].set_ylim([0, 25000])
+    # Order of every region in every year, equal counts share the same order
+    orders = (counts[:, np.newaxis, :] > counts[:, :, np.newaxis]).sum(axis=2) + 1
+
+    # Plot a bar chart for each year
+    for i, year in enumerate(years):
+        present = counts[i] > 0
+
+        if i == len(years) - 1 and last_month < 12:
+            axs[i].title.set_text(f"Počet dopravních nehod v roce {year} (leden - {months[last_month - 1]})")
+        else:
+            axs[i].title.set_text(f"Počet dopravních nehod v roce {year}")
+        axs[i].bar(regions[present], counts[i][present])
+
+        axs[i].set_ylim([0, ylim])
 
         # Horizontal lines for better readability
-        for j in range(5000, 25000, 5000):
+        for j in range(5000, ylim, 5000):
             axs[i].axhline(y = j, color='gray', alpha=0.2, linestyle='--')
 
         # Display order of accidents above each bar
-        for j, v in enumerate(counts):
-            axs[i].text(j, v + 400, str(np.where(s_counts == v)[0][0] + 1) + '.', color='cornflowerblue', fontweight='bold', ha='center')
-
-        i += 1
+        for j, (v, order) in enumerate(zip(counts[i][present], orders[i][present])):
+            axs[i].text(j, v + ylim / 62.5, f"{order}.", color='cornflowerblue', fontweight='bold', ha='center')
 
     fig.tight_layout()
 
@@ -0,0 +1,208 @@
+"""IZV project instrumentation
+
+This module collects timers and counters of pipeline stages (downloading, parsing, cache reads and writes,
+analysis and maps) and can capture a cProfile profile and tracemalloc statistics of a run.
+Collection is disabled by default, so instrumented code only checks a flag.
+
+Metrics can be enabled from code using enable() or by environment variables:
+IZV_METRICS -- JSON file the metrics report is written to when the program exits
+IZV_PROFILE -- file the cProfile profile of the whole run is written to (readable by pstats or snakeviz)
+IZV_TRACEMALLOC -- if set, memory allocations are traced and the largest ones are added to the report,
+                   the report is printed to stderr if IZV_METRICS is not set
+
+Metrics of worker processes (get_list and get_clusters with workers) are not collected.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import atexit
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+_enabled = False
+_lock = threading.Lock() # Archives are downloaded by several threads
+_timers = dict() # Name -> [calls, seconds]
+_counters = dict() # Name -> value
+_memory = dict()
+
+
+def enable(enabled: bool = True):
+    """Enable or disable collection of metrics"""
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    """True if metrics are collected"""
+    return _enabled
+
+
+def reset():
+    """Forget all collected metrics"""
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _memory.clear()
+
+
+def count(name: str, value: int = 1):
+    """Add value to counter
+
+    Keyword arguments:
+    name -- name of the counter, e.g. cache.partition_hits
+    value -- value added to the counter (default 1)
+    """
+    if not _enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def add_time(name: str, seconds: float):
+    """Add one call taking seconds to timer"""
+    with _lock:
+        timer = _timers.setdefault(name, [0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+
+
+@contextlib.contextmanager
+def timer(name: str):
+    """Measure wall time of a block, nested timers measure time including inner blocks
+
+    Keyword arguments:
+    name -- name of the timer, e.g. cache.read
+    """
+    if not _enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """Decorator measuring wall time of every call of a function
+
+    Keyword arguments:
+    name -- name of the timer
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+
+            with timer(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def report() -> dict:
+    """Structured report of collected metrics
+
+    Returns:
+    Dictionary with timers (calls, total and mean seconds), counters and hit ratios of counters
+    named <prefix>_hits and <prefix>_misses, and memory statistics if they were captured
+    """
+    with _lock:
+        timers = {name: {"calls": calls, "seconds": round(seconds, 6), "mean_seconds": round(seconds / calls, 6)}
+                  for name, (calls, seconds) in sorted(_timers.items())}
+        counters = dict(sorted(_counters.items()))
+        memory = dict(_memory)
+
+    ratios = dict()
+    for name, hits in counters.items():
+        if name.endswith("_hits"):
+            misses = counters.get(f"{name[:-5]}_misses", 0)
+            ratios[name[:-5]] = round(hits / (hits + misses), 4) if hits + misses else None
+
+    result = {"timers": timers, "counters": counters, "hit_ratios": ratios}
+    if memory:
+        result["memory"] = memory
+
+    return result
+
+
+def save_report(filename: str):
+    """Write report of collected metrics to a JSON file"""
+    with open(filename, "w") as f:
+        json.dump(report(), f, indent=2)
+
+
+@contextlib.contextmanager
+def capture(profile_file: str = None, trace_memory: bool = False, top: int = 20):
+    """Capture cProfile profile and/or memory allocations of a block, metrics are enabled inside the block
+
+    Keyword arguments:
+    profile_file -- file the profile is written to, None disables profiling (default None)
+    trace_memory -- if True, peak traced memory and the largest allocations (by line) are added to the report (default False)
+    top -- number of reported allocations (default 20)
+    """
+    was_enabled = _enabled
+    enable()
+
+    profiler = cProfile.Profile() if profile_file else None
+    if trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            with _lock:
+                _memory["current_mb"] = round(current / 1024 ** 2, 3)
+                _memory["peak_mb"] = round(peak / 1024 ** 2, 3)
+                _memory["top"] = [{"location": str(stat.traceback), "size_mb": round(stat.size / 1024 ** 2, 3), "count": stat.count}
+                                  for stat in snapshot.statistics("lineno")[:top]]
+
+        enable(was_enabled)
+
+
+def _start_from_environment():
+    """Enable metrics and capture requested by environment variables, results are written when the program exits"""
+    report_file = os.environ.get("IZV_METRICS")
+    profile_file = os.environ.get("IZV_PROFILE")
+    trace_memory = bool(os.environ.get("IZV_TRACEMALLOC"))
+
+    if not (report_file or profile_file or trace_memory):
+        return
+
+    run = capture(profile_file, trace_memory)
+    run.__enter__()
+
+    def finish():
+        run.__exit__(None, None, None)
+        if report_file:
+            save_report(report_file)
+        elif trace_memory: # Memory statistics would be lost otherwise
+            print(json.dumps(report(), indent=2), file=sys.stderr)
+
+    atexit.register(finish)
+
+
+_start_from_environment()
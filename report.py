@@ -0,0 +1,288 @@
+"""IZV project report
+
+This module renders all figures of the project with a single command. Data are loaded once
+and independent figures are rendered in parallel processes. Figures whose inputs did not change
+since the last build are skipped.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import argparse
+import ast
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved, never displayed
+
+# Figures of the report: output file -> (module, function, data the function needs, keyword arguments)
+FIGURES = {
+    "conseq.pdf": ("analysis", "plot_conseq", "df", {}),
+    "damage.pdf": ("analysis", "plot_damage", "df", {}),
+    "surface.pdf": ("analysis", "plot_surface", "df", {}),
+    "geo1.png": ("geo", "plot_geo", "gdf", {"show_figure": False}),
+    "geo2.png": ("geo", "plot_cluster", "gdf", {"show_figure": False}),
+    "crashes.pdf": ("get_stat", "plot_stat", "data_source", {}),
+    "fig.pdf": ("doc.doc", "plot_weather", "df", {}),
+}
+
+# Modules loading data of every kind, see load_data
+DATA_MODULES = {"df": ["analysis"], "gdf": ["analysis", "geo"], "data_source": ["download"]}
+
+# Data loaded by the main process, worker processes inherit it when they are forked
+_DATA = dict()
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("figures", help=f"Figures to render, any of {', '.join(FIGURES)} (default all)", nargs="*")
+    parser.add_argument("--data", help="File containing the data", default="accidents.pkl.gz")
+    parser.add_argument("--workers", help="Number of rendering processes", type=int, default=os.cpu_count())
+    parser.add_argument("--state", help="File storing fingerprints of rendered figures", default=".report.json")
+    parser.add_argument("--force", help="Render figures even if their inputs did not change", action="store_true")
+
+    return parser.parse_args()
+
+
+def file_fingerprint(path: str) -> list:
+    """Fingerprint of a file based on its size and modification time, None if the file does not exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def data_fingerprint(kind: str, data_file: str) -> list:
+    """Fingerprint of data a figure is rendered from
+
+    Keyword arguments:
+    kind -- kind of data ("df", "gdf" or "data_source")
+    data_file -- file containing the dataframe
+    """
+    if kind == "data_source":
+        import download as dl
+
+        downloader = dl.DataDownloader()
+        return [file_fingerprint(f"./{downloader.folder}/{archive}") for archive in downloader.data_archives]
+
+    return file_fingerprint(data_file)
+
+
+def dependencies(modules: list) -> list:
+    """Find source files of project modules and of all project modules they import, directly or indirectly.
+    Imports inside functions are found as well, imported modules which are not files of the project are ignored.
+
+    Keyword arguments:
+    modules -- names of modules, e.g. doc.doc
+
+    Returns:
+    Sorted list of paths of source files relative to the project folder
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    stack = [os.path.join(root, f"{module.replace('.', os.sep)}.py") for module in modules]
+    found = set()
+
+    while stack:
+        path = stack.pop()
+        if path in found or not os.path.isfile(path):
+            continue
+        found.add(path)
+
+        with open(path, "rb") as f:
+            tree = ast.parse(f.read(), path)
+
+        folder = os.path.dirname(path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom): # Imported names may be modules as well
+                names = [f"{node.module}.{alias.name}" if node.module else alias.name for alias in node.names]
+                names += [node.module] if node.module else []
+            else:
+                continue
+
+            # Absolute imports are looked up in the project folder and in folder of the module (modules run as scripts),
+            # relative imports in the package of the module
+            if isinstance(node, ast.ImportFrom) and node.level:
+                bases = [os.path.normpath(os.path.join(folder, *[os.pardir] * (node.level - 1)))]
+            else:
+                bases = [root, folder]
+
+            stack.extend(os.path.join(base, f"{name.replace('.', os.sep)}.py") for name in names for base in bases)
+
+    return sorted(os.path.relpath(path, root) for path in found)
+
+
+def figure_key(name: str, data_file: str) -> str:
+    """Compute key identifying inputs of a figure, that is its data, plot parameters and the code of the project
+    modules used to load the data and to plot the figure
+
+    Keyword arguments:
+    name -- output file of the figure
+    data_file -- file containing the dataframe
+    """
+    module, function, kind, kwargs = FIGURES[name]
+    root = os.path.dirname(os.path.abspath(__file__))
+    code = hashlib.sha1()
+
+    for path in dependencies([module] + DATA_MODULES[kind]):
+        with open(os.path.join(root, path), "rb") as f:
+            code.update(path.encode() + b"\0" + f.read() + b"\0")
+
+    inputs = [name, function, kwargs, data_fingerprint(kind, data_file), code.hexdigest()]
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def load_data(kinds: set, data_file: str) -> set:
+    """Load data needed by figures into _DATA, every kind is loaded separately, so that a failure
+    affects only figures using that kind of data
+
+    Keyword arguments:
+    kinds -- kinds of data to load ("df", "gdf" and/or "data_source")
+    data_file -- file containing the dataframe
+
+    Returns:
+    Set of kinds which failed to load
+    """
+    failed = set()
+
+    # df is loaded first, gdf is made from it
+    for kind in ("df", "gdf", "data_source"):
+        if kind not in kinds and not (kind == "df" and "gdf" in kinds):
+            continue
+
+        if kind == "gdf" and "df" in failed:
+            failed.add(kind)
+            continue
+
+        try:
+            _DATA[kind] = load_kind(kind, data_file)
+        except Exception as e:
+            print(f"ERROR: loading {kind} failed: {e}", file=sys.stderr)
+            failed.add(kind)
+
+    return failed
+
+
+def load_kind(kind: str, data_file: str):
+    """Load one kind of data, gdf is made from already loaded df
+
+    Keyword arguments:
+    kind -- kind of data ("df", "gdf" or "data_source")
+    data_file -- file containing the dataframe
+    """
+    if kind == "df":
+        if not os.path.isfile(data_file): # get_dataframe quits the program in that case
+            raise FileNotFoundError(f"File '{data_file}' not found")
+
+        import analysis
+        return analysis.get_dataframe(data_file)
+
+    if kind == "gdf":
+        import geo
+        return geo.make_geo(_DATA["df"].copy())
+
+    import download as dl
+    return dl.DataDownloader().get_list()
+
+
+def render(name: str) -> str:
+    """Render a single figure from data in _DATA, used by worker processes
+
+    Keyword arguments:
+    name -- output file of the figure
+    """
+    module, function, kind, kwargs = FIGURES[name]
+
+    data = _DATA[kind]
+    if kind == "df":
+        data = data.copy() # Some plot functions add columns to the dataframe
+
+    fig_location = name
+    if module == "get_stat": # plot_stat expects a folder
+        fig_location = os.path.dirname(os.path.abspath(name))
+
+    getattr(importlib.import_module(module), function)(data, fig_location, **kwargs)
+
+    return name
+
+
+def build_report(figures: list = None, data_file: str = "accidents.pkl.gz", workers: int = None, state_file: str = ".report.json", force: bool = False) -> list:
+    """Render figures of the report, skipping those whose inputs did not change
+
+    Keyword arguments:
+    figures -- output files of figures to render (default all figures)
+    data_file -- file containing the dataframe (default accidents.pkl.gz)
+    workers -- number of rendering processes (default number of CPUs)
+    state_file -- file storing fingerprints of rendered figures (default .report.json)
+    force -- if True, all figures are rendered (default False)
+
+    Returns:
+    List of rendered figures
+    """
+    if not figures:
+        figures = list(FIGURES)
+
+    for name in figures:
+        if name not in FIGURES:
+            print(f"ERROR: unknown figure '{name}', quitting", file=sys.stderr)
+            sys.exit(1)
+
+    state = dict()
+    if os.path.isfile(state_file):
+        with open(state_file, "r") as f:
+            state = json.load(f)
+
+    keys = {name: figure_key(name, data_file) for name in figures}
+    stale = [name for name in figures if force or state.get(name) != keys[name] or not os.path.isfile(name)]
+
+    for name in figures:
+        if name not in stale:
+            print(f"Skipping {name}, inputs did not change", file=sys.stderr)
+
+    if not stale:
+        return list()
+
+    failed = load_data({FIGURES[name][2] for name in stale}, data_file)
+
+    for name in stale:
+        if FIGURES[name][2] in failed:
+            print(f"ERROR: rendering {name} failed: its data could not be loaded", file=sys.stderr)
+    stale = [name for name in stale if FIGURES[name][2] not in failed]
+
+    rendered = list()
+    if stale:
+        # Workers are forked, so they share already loaded data with the main process
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = {name: executor.submit(render, name) for name in stale}
+
+            for name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"ERROR: rendering {name} failed: {e}", file=sys.stderr)
+                    continue
+
+                print(f"Rendered {name}", file=sys.stderr)
+                state[name] = keys[name]
+                rendered.append(name)
+
+    with open(state_file, "w") as f:
+        json.dump(state, f, indent=2)
+
+    return rendered
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    build_report(args.figures, args.data, args.workers, args.state, args.force)
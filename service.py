@@ -0,0 +1,315 @@
+"""IZV project query service
+
+This module implements a small HTTP service answering aggregate queries about car crashes.
+Columns needed by queries are loaded once from cache directories of DataDownloader and kept in memory,
+queries are computed in a thread pool and their results are cached by query.
+
+Endpoints (all GET, results are JSON):
+/counts?by=region,year,p18 -- number of crashes grouped by any of region, year and weather (p18)
+/injuries -- number of crashes and sums of killed (p13a), severely (p13b) and lightly (p13c) injured per region
+/bbox?xmin=&ymin=&xmax=&ymax=&limit= -- crashes inside bounding box in S-JTSK coordinates
+/stats -- statistics of the service
+Every query can be filtered by parameters region, year and p18, which accept comma separated lists of values.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import argparse
+import asyncio
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import download as dl
+import metrics
+
+# HTTP status codes used by the service
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class Dataset:
+    """Columns of crash data needed by queries, kept in memory"""
+
+    COLUMNS = ["p1", "p2a", "p13a", "p13b", "p13c", "p18", "d", "e", "region"]
+    GROUPS = ["region", "year", "p18"]
+
+    def __init__(self, downloader, regions=None):
+        """Load columns of regions from cache directories (parsing data which are not cached)
+
+        Keyword arguments:
+        downloader -- DataDownloader instance
+        regions -- list of region acronyms (default all regions)
+        """
+        names, data = downloader.select(self.COLUMNS, regions=regions)
+        self.cols = dict(zip(names, data))
+        self.region_names = list(downloader.vocabulary["region"])
+        self.rows = len(self.cols["p1"])
+
+        dates = self.cols["p2a"]
+        years = dates.astype("datetime64[Y]").astype(np.int64) + 1970
+        years[np.isnat(dates)] = 0
+        self.cols["year"] = years
+
+        # Codes of groups are computed once, so that queries only count them
+        self.groups = dict()
+        for name in self.GROUPS:
+            values, inverse = np.unique(self.cols[name], return_inverse=True)
+            self.groups[name] = (values, inverse.reshape(-1))
+
+        self.index = None
+        self.index_lock = threading.Lock()
+
+    def label(self, name, value):
+        """Value of group used in results"""
+        return self.region_names[value] if name == "region" else int(value)
+
+    def mask(self, params):
+        """Rows matching filters region, year and p18 in params, None if there are no filters"""
+        mask = None
+
+        for name in ["region", "year", "p18"]:
+            if name not in params:
+                continue
+
+            if name == "region":
+                unknown = [value for value in params[name] if value not in self.region_names]
+                if unknown:
+                    raise ValueError(f"Unknown region {', '.join(unknown)}")
+                values = [self.region_names.index(value) for value in params[name]]
+            else:
+                values = [int(value) for value in params[name]]
+
+            condition = np.isin(self.cols[name], values)
+            mask = condition if mask is None else mask & condition
+
+        return mask
+
+    def counts(self, params):
+        """Number of crashes grouped by columns in parameter by"""
+        by = params.get("by", ["region"])
+        if not by:
+            raise ValueError("Parameter by is empty")
+        for name in by:
+            if name not in self.groups:
+                raise ValueError(f"Can not group by '{name}', use {', '.join(self.GROUPS)}")
+
+        mask = self.mask(params)
+        codes = [self.groups[name][1] if mask is None else self.groups[name][1][mask] for name in by]
+        dims = [len(self.groups[name][0]) for name in by]
+
+        counts = np.bincount(np.ravel_multi_index(codes, dims), minlength=int(np.prod(dims)))
+        result = list()
+
+        for flat in np.flatnonzero(counts):
+            group = np.unravel_index(flat, dims)
+            row = {name: self.label(name, self.groups[name][0][code]) for name, code in zip(by, group)}
+            row["count"] = int(counts[flat])
+            result.append(row)
+
+        return {"by": by, "rows": result}
+
+    def injuries(self, params):
+        """Number of crashes and injured people per region"""
+        mask = self.mask(params)
+        regions = self.groups["region"][1] if mask is None else self.groups["region"][1][mask]
+        n_regions = len(self.groups["region"][0])
+        sums = dict()
+
+        for name in ["p13a", "p13b", "p13c"]:
+            col = self.cols[name] if mask is None else self.cols[name][mask]
+            sums[name] = np.bincount(regions, weights=np.maximum(col, 0), minlength=n_regions) # Ignore missing values
+
+        crashes = np.bincount(regions, minlength=n_regions)
+
+        return {"rows": [{
+            "region": self.label("region", region),
+            "crashes": int(crashes[i]),
+            "killed": int(sums["p13a"][i]),
+            "severely_injured": int(sums["p13b"][i]),
+            "lightly_injured": int(sums["p13c"][i]),
+        } for i, region in enumerate(self.groups["region"][0]) if crashes[i]]}
+
+    def bbox(self, params):
+        """Crashes inside bounding box"""
+        try:
+            box = [float(params[name][0]) for name in ["xmin", "ymin", "xmax", "ymax"]]
+        except KeyError as e:
+            raise ValueError(f"Missing parameter {e}")
+        limit = int(params.get("limit", ["100"])[0])
+
+        with self.index_lock: # Built by the first bbox query
+            if self.index is None:
+                import geo
+                self.index = geo.GridIndex(self.cols["d"], self.cols["e"])
+
+        rows = self.index.bbox(*box)
+        mask = self.mask(params)
+        if mask is not None:
+            rows = rows[mask[rows]]
+
+        return {"count": len(rows), "crashes": [{
+            "p1": int(self.cols["p1"][row]),
+            "date": str(self.cols["p2a"][row]),
+            "region": self.label("region", self.cols["region"][row]),
+            "d": float(self.cols["d"][row]),
+            "e": float(self.cols["e"][row]),
+        } for row in rows[:limit]]}
+
+
+class QueryService:
+    """HTTP service answering queries from Dataset"""
+
+    def __init__(self, dataset, workers=4, cache_size=1024):
+        """Initialize service
+
+        Keyword arguments:
+        dataset -- Dataset instance
+        workers -- number of threads computing queries (default 4)
+        cache_size -- number of cached query results (default 1024)
+        """
+        self.dataset = dataset
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cache = OrderedDict() # Query key -> response body, least recently used first
+        self.cache_size = cache_size
+        self.pending = dict() # Query key -> future of a query which is being computed
+        self.handlers = {"/counts": dataset.counts, "/injuries": dataset.injuries, "/bbox": dataset.bbox}
+        self.stats = {"requests": 0, "cache_hits": 0, "cache_misses": 0, "errors": 0}
+
+    async def query(self, path, params):
+        """Answer a query, results are cached and identical concurrent queries are computed only once
+
+        Returns:
+        Tuple of HTTP status and response body (bytes)
+        """
+        if path == "/stats":
+            return 200, json.dumps({**self.stats, "rows": self.dataset.rows, "cached": len(self.cache), "metrics": metrics.report()}).encode()
+
+        if path not in self.handlers:
+            return 404, json.dumps({"error": f"Unknown path {path}"}).encode()
+
+        key = (path, tuple(sorted((name, tuple(values)) for name, values in params.items())))
+
+        if key in self.cache:
+            self.stats["cache_hits"] += 1
+            self.cache.move_to_end(key)
+            return 200, self.cache[key]
+
+        self.stats["cache_misses"] += 1
+
+        if key not in self.pending:
+            loop = asyncio.get_running_loop()
+            self.pending[key] = loop.run_in_executor(self.executor, self.compute, self.handlers[path], params)
+
+        try:
+            body = await asyncio.shield(self.pending[key])
+        except ValueError as e:
+            return 400, json.dumps({"error": str(e)}).encode()
+        finally:
+            self.pending.pop(key, None)
+
+        self.cache[key] = body
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return 200, body
+
+    def compute(self, handler, params):
+        """Compute query result in a worker thread"""
+        with metrics.timer(f"service.{handler.__name__}"):
+            return json.dumps(handler(params)).encode()
+
+    async def handle(self, reader, writer):
+        """Serve requests of one connection, connections are kept alive unless the client closes them"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                start = time.perf_counter()
+                self.stats["requests"] += 1
+
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    status, body = 400, json.dumps({"error": "Malformed request"}).encode()
+                    method, target, version = "", "", "HTTP/1.0"
+                else:
+                    if method != "GET":
+                        status, body = 405, json.dumps({"error": "Only GET is supported"}).encode()
+                    else:
+                        url = urlsplit(target)
+                        params = {name: [item for value in values for item in value.split(",") if item]
+                                  for name, values in parse_qs(url.query).items()}
+                        try:
+                            status, body = await self.query(url.path, params)
+                        except Exception as e: # Keep serving other requests
+                            print(f"ERROR: {target}: {e!r}", file=sys.stderr)
+                            status, body = 500, json.dumps({"error": "Internal error"}).encode()
+
+                if status != 200:
+                    self.stats["errors"] += 1
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                writer.write((f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                              f"Content-Type: application/json\r\n"
+                              f"Content-Length: {len(body)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + body)
+                await writer.drain()
+                if metrics.is_enabled():
+                    metrics.add_time("service.request", time.perf_counter() - start)
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        """Serve requests until cancelled"""
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving {self.dataset.rows} crashes on http://{host}:{port}", file=sys.stderr)
+
+        async with server:
+            await server.serve_forever()
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--host", help="Address to listen on", default="127.0.0.1")
+    parser.add_argument("--port", help="Port to listen on", type=int, default=8080)
+    parser.add_argument("--regions", help="Regions to serve (default all regions)", nargs="*")
+    parser.add_argument("--folder", help="Folder with data archives and cache directories", default="data")
+    parser.add_argument("--url", help="URL of data archives, e.g. a local mirror", default="https://ehw.fit.vutbr.cz/izv/")
+    parser.add_argument("--workers", help="Number of threads computing queries", type=int, default=4)
+    parser.add_argument("--cache-size", help="Number of cached query results", type=int, default=1024)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    downloader = dl.DataDownloader(args.url, args.folder)
+    service = QueryService(Dataset(downloader, args.regions or None), args.workers, args.cache_size)
+
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
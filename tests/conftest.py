@@ -0,0 +1,11 @@
+"""IZV project tests
+
+Modules of the project are in the parent folder, tests import them directly.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
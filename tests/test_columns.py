@@ -0,0 +1,66 @@
+"""IZV project tests of columnar conversion
+
+Columns built by DataDownloader.build_columns are compared with the cell by cell reference
+implementation from the columns benchmark.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import numpy as np
+import pytest
+import download as dl
+from benchmark import legacy_build_columns, make_rows
+
+# Cells which are hard to parse
+EDGE_CELLS = ["", " ", "-", "+", "+-5", "--1", "+5", " 7 ", "-0", "5.0", "1,5", ".5", "5.", "1e3", "1e", "e3",
+              "1_000", "1__0", "_1", "nan", "-INF", "abc", "1.2.3", "+.5", "-.", ".", "5-", "\t5", "5 "]
+
+
+def reference(cell: str, dtype: str):
+    """Value of a cell converted by int() or float(), ERROR_VALUE if the conversion fails or the integer does not fit"""
+    try:
+        if dtype == "int":
+            value = int(cell)
+            return value if np.iinfo(np.int64).min <= value <= np.iinfo(np.int64).max else dl.ERROR_VALUE
+        return float(cell.replace(',', '.'))
+    except ValueError:
+        return dl.ERROR_VALUE
+
+
+def test_build_columns_matches_reference():
+    downloader = dl.DataDownloader()
+    rows = make_rows(downloader.data_types, 2000)
+
+    legacy = legacy_build_columns(downloader.data_types, rows)
+    columnar = downloader.build_columns(rows)
+
+    for header, t, a, b in zip(downloader.col_headers, downloader.data_types, legacy, columnar):
+        if t == "category":
+            b = downloader.decode(header, b)
+        elif t.startswith("datetime64"):
+            a = a.astype(t)
+        assert np.array_equal(a, b, equal_nan=t.startswith("datetime64")), f"Column {header} differs from reference"
+
+
+@pytest.mark.parametrize("dtype", ["int", "float"])
+def test_to_numeric_edge_cells(dtype):
+    # Edge cells are checked alone and mixed with valid cells, so both the fast path and the fallback are used
+    for cells in [EDGE_CELLS, [cell for edge in EDGE_CELLS for cell in (edge, "12")], ["9" * 19, "5", "", "-" + "9" * 18], ["ž", "5"]]:
+        expected = np.array([reference(cell, dtype) for cell in cells], dtype=dtype)
+        assert np.array_equal(dl.to_numeric(cells, dtype), expected, equal_nan=True), f"Cells {cells} differ from reference"
+
+
+@pytest.mark.parametrize("dtype", ["int", "float"])
+def test_to_numeric_random_cells(dtype):
+    rng = np.random.RandomState(0)
+    alphabet = list("0123456789+-.,e _\tnaif")
+
+    for _ in range(500):
+        cells = ["".join(rng.choice(alphabet, size=rng.randint(0, 6))) for _ in range(rng.randint(1, 20))]
+        expected = np.array([reference(cell, dtype) for cell in cells], dtype=dtype)
+        assert np.array_equal(dl.to_numeric(cells, dtype), expected, equal_nan=True), f"Cells {cells} differ from reference"
+
+
+def test_to_numeric_empty():
+    assert len(dl.to_numeric([], "int")) == 0
+    assert np.array_equal(dl.to_numeric([""], "float"), [dl.ERROR_VALUE])
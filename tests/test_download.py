@@ -0,0 +1,100 @@
+"""IZV project tests of downloading archives
+
+Generated archives are served by a local HTTP server answering conditional (ETag) and range
+requests like the original data source, so no data are downloaded from the internet.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import http.server
+import os
+import threading
+import pytest
+import download as dl
+from benchmark import ArchiveRequestHandler, write_archives
+
+ARCHIVES = dl.LEGACY_ARCHIVES[:2]
+
+
+@pytest.fixture
+def mirror(tmp_path, monkeypatch):
+    """Local HTTP server with generated archives, yields URL of the server and folder of the archives"""
+    folder = tmp_path / "mirror"
+    downloader = dl.DataDownloader()
+    write_archives(str(folder), ARCHIVES, downloader.region_files, downloader.data_types, 100, 0, downloader.col_headers)
+
+    handler = lambda *args, **kwargs: ArchiveRequestHandler(*args, directory=str(folder), **kwargs)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.chdir(tmp_path) # DataDownloader uses relative paths
+
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/", folder
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def download(url, archives=ARCHIVES):
+    """Download archives and return downloaded archives and sorted requests (archive, status) received by the server"""
+    ArchiveRequestHandler.requests.clear()
+    downloaded = dl.DataDownloader(url).download_archives(archives)
+    return downloaded, sorted(ArchiveRequestHandler.requests)
+
+
+def assert_same(folder, archives=ARCHIVES):
+    """Downloaded archives must be the same as the archives on the server"""
+    for archive in archives:
+        with open(os.path.join("data", archive), "rb") as f:
+            assert f.read() == (folder / archive).read_bytes(), f"{archive} differs from the archive on the server"
+
+
+def test_download_and_revalidate(mirror):
+    url, folder = mirror
+
+    downloaded, requests = download(url)
+    assert downloaded == ARCHIVES
+    assert {status for _, status in requests} == {200}
+    assert_same(folder)
+
+    # Unchanged archives are only revalidated
+    downloaded, requests = download(url)
+    assert downloaded == []
+    assert {status for _, status in requests} == {304}
+    assert_same(folder)
+
+
+def test_resume_partial_download(mirror):
+    url, folder = mirror
+    download(url)
+
+    # Interrupted download, only a half of the archive was written
+    data = (folder / ARCHIVES[0]).read_bytes()
+    os.remove(os.path.join("data", ARCHIVES[0]))
+    with open(os.path.join("data", f"{ARCHIVES[0]}.part"), "wb") as f:
+        f.write(data[:len(data) // 2])
+
+    downloaded, requests = download(url)
+    assert downloaded == [ARCHIVES[0]]
+    assert (ARCHIVES[0], 206) in requests
+    assert_same(folder)
+
+
+def test_download_changed_archive(mirror):
+    url, folder = mirror
+    download(url)
+
+    downloader = dl.DataDownloader()
+    write_archives(str(folder), ARCHIVES[-1:], downloader.region_files, downloader.data_types, 100, 1, downloader.col_headers)
+
+    downloaded, requests = download(url)
+    assert downloaded == ARCHIVES[-1:]
+    assert (ARCHIVES[-1], 200) in requests
+    assert_same(folder)
+
+
+def test_missing_archive(mirror):
+    url, _ = mirror
+
+    with pytest.raises(ValueError, match="datagis2099.zip"):
+        dl.DataDownloader(url).download_archives(["datagis2099.zip"])
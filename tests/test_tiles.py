@@ -0,0 +1,89 @@
+"""IZV project tests of the tile cache and basemaps
+
+Tiles are generated locally and the cache works offline, so no tiles are downloaded.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import time
+import matplotlib
+matplotlib.use("Agg") # Figures are only drawn
+
+import matplotlib.pyplot as plt
+import mercantile
+import numpy as np
+import pytest
+import tiles
+from benchmark import tile_colour, tile_png
+
+ZOOM = 12
+
+# Unreachable source, a download attempt would fail the tests
+SOURCE = {"name": "local", "url": "http://127.0.0.1:9/{z}/{x}/{y}.png", "attribution": "Generated tiles"}
+
+
+@pytest.fixture(scope="module")
+def area():
+    """Generated tiles of a small area in the corner of the Czech Republic, tile -> PNG data"""
+    bounds = (*tiles.CZ_BOUNDS[:2], tiles.CZ_BOUNDS[0] + 0.3, tiles.CZ_BOUNDS[1] + 0.2)
+    return {tile: tile_png(tile) for tile in mercantile.tiles(*bounds, ZOOM)}
+
+
+def test_stored_tiles_are_read_back(area, tmp_path):
+    with tiles.get_cache(SOURCE, str(tmp_path), max_bytes=None, offline=True) as cache:
+        cache.put(area)
+
+        assert cache.get(list(area)) == area
+        assert cache.get([mercantile.Tile(0, 0, 0)]) == dict(), "Missing tile was found"
+        assert cache.session is None, "Offline cache tried to download a tile"
+
+
+def test_basemap_is_placed_at_extent_of_tiles(area, tmp_path):
+    with tiles.get_cache(SOURCE, str(tmp_path), max_bytes=None, offline=True) as cache:
+        cache.put(area)
+
+        # Basemap of the middle of the area drawn only from cached tiles, axes do not end at borders of tiles
+        bounds = mercantile.xy_bounds(list(area)[len(area) // 2])
+        width = bounds.right - bounds.left
+        xmin, xmax = bounds.left + width / 4, bounds.right + width * 1.5
+        ymin, ymax = bounds.bottom + width / 4, bounds.top + width / 2
+        fig, ax = plt.subplots()
+        ax.set(xlim=(xmin, xmax), ylim=(ymin, ymax))
+        tiles.add_basemap(ax, ZOOM, SOURCE, cache)
+
+        left, right, bottom, top = ax.images[0].get_extent()
+        image = ax.images[0].get_array()
+        plt.close(fig)
+
+    assert ax.get_xlim() == (xmin, xmax) and ax.get_ylim() == (ymin, ymax), "Basemap changed extent of axes"
+    assert left <= xmin and right >= xmax and bottom <= ymin and top >= ymax, "Basemap does not cover axes"
+
+    # Every tile of the stitched image has the colour of its tile (missing tiles are transparent) and lies at its extent
+    covered = list(mercantile.tiles(*mercantile.lnglat(xmin, ymin), *mercantile.lnglat(xmax, ymax), ZOOM))
+    assert any(tile in area for tile in covered), "Basemap does not contain any generated tile"
+
+    x0, y0 = min(tile.x for tile in covered), min(tile.y for tile in covered)
+    assert image.shape[:2] == ((max(tile.y for tile in covered) - y0 + 1) * 256, (max(tile.x for tile in covered) - x0 + 1) * 256)
+
+    for tile in covered:
+        pixel = tuple(image[(tile.y - y0) * 256 + 128, (tile.x - x0) * 256 + 128])
+        assert pixel == (tile_colour(tile) + (255,) if tile in area else (0, 0, 0, 0)), f"Tile {tile} is misplaced"
+
+        bounds = mercantile.xy_bounds(tile)
+        assert np.isclose(bounds.left, left + (tile.x - x0) * (right - left) / (image.shape[1] // 256))
+        assert np.isclose(bounds.top, top - (tile.y - y0) * (top - bottom) / (image.shape[0] // 256))
+
+
+def test_least_recently_used_tile_is_evicted(area, tmp_path):
+    first, second, third = list(area)[:3]
+
+    with tiles.get_cache(SOURCE, str(tmp_path), max_bytes=len(area[first]) + len(area[third]), offline=True) as cache:
+        cache.put({first: area[first]})
+        time.sleep(0.01)
+        cache.put({second: area[second]})
+        time.sleep(0.01)
+        cache.get([first]) # First tile becomes more recently used than the second one
+        time.sleep(0.01)
+        cache.put({third: area[third]})
+
+        assert set(cache.get([first, second, third])) == {first, third}, "Least recently used tile was not evicted"
@@ -0,0 +1,369 @@
+"""IZV project basemap tiles
+
+This module stores basemap tiles in a local MBTiles (SQLite) file, so maps can be rendered
+without downloading tiles again or without network access at all. Tiles are downloaded only
+when they are missing, least recently used tiles are evicted when the file grows too large.
+Maps are rendered only from cached tiles if environment variable IZV_OFFLINE is set.
+"""
+
+__author__ = "Martin Kostelník (xkoste12)"
+
+import argparse
+import io
+import math
+import os
+import sqlite3
+import sys
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import mercantile
+import numpy as np
+import requests
+import requests.adapters
+from PIL import Image
+import metrics
+
+# Basemap used by maps of the project
+TONER_LITE = {
+    "name": "Stamen.TonerLite",
+    "url": "https://stamen-tiles-{s}.a.ssl.fastly.net/toner-lite/{z}/{x}/{y}{r}.png",
+    "attribution": "Map tiles by Stamen Design, CC BY 3.0 -- Map data (C) OpenStreetMap contributors",
+    "subdomains": "abcd",
+    "max_zoom": 20,
+}
+
+# Extent of the Czech Republic (west, south, east, north) in degrees, used when no data are available
+CZ_BOUNDS = (12.09, 48.55, 18.86, 51.06)
+
+# Width of the world in Web Mercator (EPSG:3857) meters
+WORLD_WIDTH = 2 * math.pi * 6378137
+
+
+class TileCache:
+    """Tiles of one tile source stored in an MBTiles file. The tiles table follows the MBTiles specification
+    (rows are in TMS order) with an extra column used to evict least recently used tiles.
+    """
+
+    def __init__(self, filename: str, source: dict = TONER_LITE, max_bytes: int = 512 * 1024 * 1024, offline: bool = False):
+        """Open tile cache, the file is created if it does not exist
+
+        Keyword arguments:
+        filename -- name of the MBTiles file
+        source -- tile source, dictionary with url, attribution and optional subdomains and max_zoom, contextily providers can be used (default TONER_LITE)
+        max_bytes -- maximal size of stored tiles, None disables eviction (default 512 MB)
+        offline -- if True, missing tiles are never downloaded (default False)
+        """
+        self.filename = filename
+        self.source = source
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.session = None
+
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        # Forked rendering processes may write concurrently, wait for locks instead of failing
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                           tile_data BLOB, last_used REAL, PRIMARY KEY (zoom_level, tile_column, tile_row))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used)")
+        self.db.executemany("INSERT OR IGNORE INTO metadata VALUES (?, ?)", [
+            ("name", source.get("name", "")), ("format", "png"), ("attribution", source.get("attribution", "")),
+        ])
+        self.db.commit()
+
+    def close(self):
+        """Close the MBTiles file"""
+        self.db.close()
+
+        if self.session is not None:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, tiles: list) -> dict:
+        """Get tiles from the cache, missing tiles are downloaded unless the cache is offline
+
+        Keyword arguments:
+        tiles -- list of mercantile.Tile
+
+        Returns:
+        Dictionary mapping tiles to PNG data (bytes), tiles which are not available are missing
+        """
+        result = dict()
+
+        for tile in tiles:
+            row = self.db.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                  (tile.z, tile.x, (1 << tile.z) - 1 - tile.y)).fetchone()
+            if row is not None:
+                result[tile] = row[0]
+
+        missing = [tile for tile in tiles if tile not in result]
+        metrics.count("tiles.cache_hits", len(result))
+        metrics.count("tiles.cache_misses", len(missing))
+
+        if missing and not self.offline:
+            downloaded = self.download(missing)
+            self.put(downloaded)
+            result.update(downloaded)
+
+        if result:
+            self.touch(list(result))
+
+        return result
+
+    def put(self, tiles: dict):
+        """Store tiles and evict least recently used tiles if the cache is too large
+
+        Keyword arguments:
+        tiles -- dictionary mapping mercantile.Tile to PNG data (bytes)
+        """
+        if not tiles:
+            return
+
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)",
+                            [(tile.z, tile.x, (1 << tile.z) - 1 - tile.y, data, now) for tile, data in tiles.items()])
+        self.db.commit()
+
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def touch(self, tiles: list):
+        """Mark tiles as recently used"""
+        now = time.time()
+        self.db.executemany("UPDATE tiles SET last_used = ? WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                            [(now, tile.z, tile.x, (1 << tile.z) - 1 - tile.y) for tile in tiles])
+        self.db.commit()
+
+    def evict(self, max_bytes: int):
+        """Delete least recently used tiles until size of stored tiles is at most max_bytes"""
+        size = self.db.execute("SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles").fetchone()[0]
+        if size <= max_bytes:
+            return
+
+        evicted = list()
+        for z, x, y, length in self.db.execute("SELECT zoom_level, tile_column, tile_row, LENGTH(tile_data) FROM tiles ORDER BY last_used"):
+            if size <= max_bytes:
+                break
+            evicted.append((z, x, y))
+            size -= length
+
+        self.db.executemany("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", evicted)
+        self.db.commit()
+
+    def tile_url(self, tile: mercantile.Tile) -> str:
+        """URL of tile in the tile source"""
+        subdomains = self.source.get("subdomains", "abc")
+        params = {**self.source, "s": subdomains[(tile.x + tile.y) % len(subdomains)], "z": tile.z, "x": tile.x, "y": tile.y, "r": ""}
+
+        return self.source["url"].format(**params)
+
+    @metrics.timed("tiles.download")
+    def download(self, tiles: list, workers: int = 8) -> dict:
+        """Download tiles from the tile source, tiles which can not be downloaded are skipped with a warning
+
+        Keyword arguments:
+        tiles -- list of mercantile.Tile
+        workers -- number of download threads (default 8)
+
+        Returns:
+        Dictionary mapping downloaded tiles to PNG data (bytes)
+        """
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+
+        def fetch(tile):
+            try:
+                response = self.session.get(self.tile_url(tile), timeout=30)
+                response.raise_for_status()
+                return tile, response.content
+            except requests.RequestException:
+                return tile, None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            downloaded = dict(executor.map(fetch, tiles))
+
+        failed = [tile for tile, data in downloaded.items() if data is None]
+        if failed:
+            warnings.warn(f"{len(failed)} of {len(tiles)} tiles could not be downloaded from {self.source.get('name', self.source['url'])}")
+
+        return {tile: data for tile, data in downloaded.items() if data is not None}
+
+
+def get_cache(source: dict = TONER_LITE, folder: str = "tiles", **kwargs) -> TileCache:
+    """Open the tile cache of a tile source, every source is stored in its own file in folder
+
+    Keyword arguments:
+    source -- tile source (default TONER_LITE)
+    folder -- folder containing tile caches (default tiles)
+    kwargs -- other arguments of TileCache
+    """
+    return TileCache(os.path.join(folder, f"{source.get('name', 'tiles')}.mbtiles"), source, **kwargs)
+
+
+def zoom_level(width: float, max_zoom: int = 20) -> int:
+    """Zoom level for a map of given width in Web Mercator meters, the map is covered by at least two tiles across"""
+    if width <= 0:
+        return max_zoom
+
+    return int(min(max(math.ceil(math.log2(2 * WORLD_WIDTH / width)), 0), max_zoom))
+
+
+def stitch(tiles: list, data: dict) -> tuple:
+    """Stitch tiles into one image
+
+    Keyword arguments:
+    tiles -- list of mercantile.Tile of the same zoom level covering a rectangle
+    data -- dictionary mapping tiles to PNG data, missing tiles are left transparent
+
+    Returns:
+    Tuple of image (ndarray) and its extent (left, right, bottom, top) in Web Mercator meters
+    """
+    xs = [tile.x for tile in tiles]
+    ys = [tile.y for tile in tiles]
+    x0, y0 = min(xs), min(ys)
+
+    size = 256
+    if data:
+        size = Image.open(io.BytesIO(next(iter(data.values())))).size[0]
+
+    image = np.zeros(((max(ys) - y0 + 1) * size, (max(xs) - x0 + 1) * size, 4), dtype=np.uint8)
+
+    for tile, png in data.items():
+        left, top = (tile.x - x0) * size, (tile.y - y0) * size
+        image[top:top + size, left:left + size] = np.asarray(Image.open(io.BytesIO(png)).convert("RGBA").resize((size, size)))
+
+    top_left = mercantile.xy_bounds(x0, y0, tiles[0].z)
+    bottom_right = mercantile.xy_bounds(max(xs), max(ys), tiles[0].z)
+
+    return image, (top_left.left, bottom_right.right, bottom_right.bottom, top_left.top)
+
+
+@metrics.timed("tiles.add_basemap")
+def add_basemap(ax, zoom: int = None, source: dict = TONER_LITE, cache: TileCache = None, offline: bool = None, attribution_size: int = 8):
+    """Add basemap to axes in Web Mercator (EPSG:3857) using tiles from the local tile cache,
+    replacement of contextily.add_basemap
+
+    Keyword arguments:
+    ax -- matplotlib axes
+    zoom -- zoom level of tiles (default computed from extent of axes)
+    source -- tile source (default TONER_LITE)
+    cache -- tile cache, the cache of source is opened if not given (default None)
+    offline -- if True, missing tiles are not downloaded and the basemap contains only cached tiles,
+               ignored if cache is given (default True if environment variable IZV_OFFLINE is set)
+    attribution_size -- font size of attribution, 0 disables attribution (default 8)
+    """
+    xmin, xmax = ax.get_xlim()
+    ymin, ymax = ax.get_ylim()
+
+    if zoom is None:
+        zoom = zoom_level(xmax - xmin, source.get("max_zoom", 20))
+
+    west, south = mercantile.lnglat(xmin, ymin)
+    east, north = mercantile.lnglat(xmax, ymax)
+    tiles = list(mercantile.tiles(west, south, east, north, zoom))
+
+    if not tiles:
+        return
+
+    if offline is None:
+        offline = bool(os.environ.get("IZV_OFFLINE"))
+
+    own_cache = cache is None
+    if own_cache:
+        cache = get_cache(source, offline=offline)
+
+    try:
+        image, extent = stitch(tiles, cache.get(tiles))
+    finally:
+        if own_cache:
+            cache.close()
+
+    ax.imshow(image, extent=extent, interpolation="bilinear", zorder=0)
+    ax.set(xlim=(xmin, xmax), ylim=(ymin, ymax)) # Keep extent of the plotted data
+
+    if attribution_size:
+        ax.text(0.005, 0.005, source.get("attribution", ""), transform=ax.transAxes, size=attribution_size, ha="left", va="bottom", wrap=True)
+
+
+def region_bounds(data_file: str) -> dict:
+    """Extents of regions (west, south, east, north) in degrees computed from crash coordinates
+
+    Keyword arguments:
+    data_file -- file containing the dataframe
+    """
+    import pandas as pd
+    import geo
+
+    gdf = geo.make_geo(pd.read_pickle(data_file))
+    px, py = geo.project(gdf)
+    regions = gdf["region"].to_numpy()
+    bounds = dict()
+
+    for region in np.unique(regions):
+        rows = regions == region
+        west, south = mercantile.lnglat(px[rows].min(), py[rows].min())
+        east, north = mercantile.lnglat(px[rows].max(), py[rows].max())
+        bounds[region] = (west, south, east, north)
+
+    return bounds
+
+
+def prefetch(bounds: list, zooms: list, source: dict = TONER_LITE, folder: str = "tiles", max_bytes: int = None) -> int:
+    """Download tiles covering extents, tiles which are already cached are not downloaded
+
+    Keyword arguments:
+    bounds -- list of extents (west, south, east, north) in degrees
+    zooms -- list of zoom levels
+    source -- tile source (default TONER_LITE)
+    folder -- folder containing tile caches (default tiles)
+    max_bytes -- maximal size of stored tiles (default unlimited)
+
+    Returns:
+    Number of tiles in the cache covering extents
+    """
+    tiles = list(dict.fromkeys(tile for extent in bounds for tile in mercantile.tiles(*extent, zooms)))
+
+    with get_cache(source, folder, max_bytes=max_bytes) as cache:
+        return len(cache.get(tiles))
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prefetch_parser = subparsers.add_parser("prefetch", help="Download tiles covering regions")
+    prefetch_parser.add_argument("regions", help="Region acronyms (default whole country)", nargs="*")
+    prefetch_parser.add_argument("--data", help="File containing the data, used to find extents of regions", default="accidents.pkl.gz")
+    prefetch_parser.add_argument("--zoom", help="Minimal and maximal zoom level", type=int, nargs=2, default=[7, 12])
+    prefetch_parser.add_argument("--folder", help="Folder containing tile caches", default="tiles")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.regions:
+        if not os.path.isfile(args.data):
+            print(f"ERROR: File '{args.data}' not found. Quitting.", file=sys.stderr)
+            sys.exit(1)
+
+        all_bounds = region_bounds(args.data)
+        bounds = [all_bounds[region] for region in args.regions if region in all_bounds]
+    else:
+        bounds = [CZ_BOUNDS]
+
+    count = prefetch(bounds, list(range(args.zoom[0], args.zoom[1] + 1)), folder=args.folder)
+    print(f"Cached tiles: {count}", file=sys.stderr)